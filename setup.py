@@ -21,6 +21,12 @@ setuptools.setup(
             "rebase_annotations="
             + "well_annotator.helper:"
             + "rebase_annotations",
+            "annotations_to_sqlite="
+            + "well_annotator.AnnotationBackends:"
+            + "annotations_to_sqlite",
+            "annotations_to_hdf5="
+            + "well_annotator.AnnotationBackends:"
+            + "annotations_to_hdf5",
         ]
     },
     )
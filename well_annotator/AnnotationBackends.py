@@ -0,0 +1,662 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Apr  4 10:23:48 2022
+
+@author: lferiani
+
+Where the annotations of a project are stored on disk.
+All backends have the same methods, so the GUI does not need to know
+which one it is using:
+    load() -> filenames_df, working_dir, annotations, nn_voting_mode
+    save(annotations, nn_voting_mode, filenames_df=None, working_dir=None)
+    compact(annotations, nn_voting_mode)
+    read_file(file_id), read_unloaded()
+    claim_file(file_id), release_file(file_id), claimed_by_others()
+    close()
+"""
+
+import os
+import time
+import getpass
+import sqlite3
+import tempfile
+import h5py
+import tables
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+from well_annotator.helper import (
+    HDF5_LOCK,
+    FILES_DF_COLS,
+    WELLS_ANNOTATION_EXT,
+    WELLS_ANNOTATION_SQLITE_EXT,
+    WELLS_ANNOTATIONS_DF_COLS,
+    WELLS_ANNOTATIONS_JOURNAL_KEY,
+    )
+from well_annotator.AnnotationStore import AnnotationStore
+
+
+def get_annotator_name():
+    """$WELL_ANNOTATOR_USER if set, or the name of the logged in user"""
+    return os.environ.get('WELL_ANNOTATOR_USER', getpass.getuser())
+
+
+def get_annotation_backend(wellsanns_file, annotator=None):
+    """Choose the backend from the file extension"""
+    if str(wellsanns_file).endswith(WELLS_ANNOTATION_SQLITE_EXT):
+        return SQLiteAnnotationBackend(wellsanns_file, annotator=annotator)
+    return HDF5AnnotationBackend(wellsanns_file)
+
+
+# /wells_annotations_df is written in table format, so that the wells of
+# a file can be read without reading the whole table
+WELLS_ANNOTATIONS_KEY = '/wells_annotations_df'
+WELLS_ANNOTATIONS_DATA_COLS = ['file_id', 'well_label']
+WELL_NAME_ITEMSIZE = 32
+WELLS_ANNOTATIONS_TABLE_KWARGS = {
+    'data_columns': WELLS_ANNOTATIONS_DATA_COLS,
+    'min_itemsize': {'well_name': WELL_NAME_ITEMSIZE},
+    'index': True,  # of the data columns
+    }
+
+
+class HDF5AnnotationBackend(object):
+    """
+    Annotations in a *_wells_annotations.hdf5 file: all of them in
+    /wells_annotations_df, plus a journal of the changes since that table
+    was last written. Only one GUI at a time can use the file.
+    Only the wells of the files in the journal are read when loading, the
+    others are read when needed (read_file, read_unloaded)
+    """
+
+    def __init__(self, wellsanns_file, journal_max_rows=50000):
+        self.wellsanns_file = Path(wellsanns_file)
+        self.annotator = None
+        # rewrite the full table when the journal gets this long
+        self.journal_max_rows = journal_max_rows
+        self._n_journal_rows = 0
+        self._journal_file_ids = set()
+        # files with wells in /wells_annotations_df not read yet
+        self._unloaded_file_ids = set()
+        self._saved_nn_voting_mode = None
+
+    def load(self):
+        with HDF5_LOCK:
+            self._convert_to_table()
+        with HDF5_LOCK, pd.HDFStore(self.wellsanns_file, 'r') as fid:
+            filenames_df = fid['/filenames_df'].copy()
+            working_dir = Path(
+                fid.get_storer('filenames_df').attrs.working_dir)
+            try:
+                nn_voting_mode = fid.get_storer(
+                    'wells_annotations_df').attrs['nn_voting_mode']
+            except KeyError:
+                nn_voting_mode = 'mode'
+            # changes saved since the table was last written
+            if WELLS_ANNOTATIONS_JOURNAL_KEY in fid:
+                journal_df = fid[WELLS_ANNOTATIONS_JOURNAL_KEY]
+            else:
+                journal_df = pd.DataFrame(columns=WELLS_ANNOTATIONS_DF_COLS)
+            self._n_journal_rows = len(journal_df)
+            self._journal_file_ids = set(
+                journal_df['file_id'].astype(int).tolist())
+
+            if fid.get_storer(WELLS_ANNOTATIONS_KEY).is_table:
+                annotations = self._load_summary(fid)
+            else:
+                # could not be converted (e.g. read-only): read in full,
+                # it'll be written as a table when compacted
+                annotations = AnnotationStore.from_dataframe(
+                    fid[WELLS_ANNOTATIONS_KEY])
+                self._unloaded_file_ids = set()
+
+        annotations.apply_changes(journal_df)
+        annotations.mark_saved()
+        self._saved_nn_voting_mode = nn_voting_mode
+        return filenames_df, working_dir, annotations, nn_voting_mode
+
+    def _convert_to_table(self):
+        """
+        Rewrite a fixed format /wells_annotations_df (older and new files)
+        as a table, so that the wells of each file can be read on their own.
+        Call with HDF5_LOCK held
+        """
+        with pd.HDFStore(self.wellsanns_file, 'r') as fid:
+            storer = fid.get_storer(WELLS_ANNOTATIONS_KEY)
+            if storer.is_table:
+                return
+            wells_df = fid[WELLS_ANNOTATIONS_KEY]
+            try:
+                nn_voting_mode = storer.attrs['nn_voting_mode']
+            except KeyError:
+                nn_voting_mode = None
+        try:
+            with pd.HDFStore(self.wellsanns_file, 'r+') as fid:
+                fid.put(
+                    WELLS_ANNOTATIONS_KEY,
+                    wells_df[WELLS_ANNOTATIONS_DF_COLS],
+                    format='table',
+                    **WELLS_ANNOTATIONS_TABLE_KWARGS)
+            # rewriting the table loses its attributes
+            if nn_voting_mode is not None:
+                with h5py.File(self.wellsanns_file, 'r+') as fid:
+                    fid["/wells_annotations_df"].attrs["nn_voting_mode"] = (
+                        str(nn_voting_mode))
+        except (OSError, ValueError) as e:
+            print(f'Could not convert {self.wellsanns_file} to table '
+                  f'format, reading it in full: {e!r}')
+
+    def _load_summary(self, fid):
+        """
+        Read the wells of the files in the journal, only count the
+        unlabelled wells of the others
+        """
+        file_ids = fid.select_column(WELLS_ANNOTATIONS_KEY, 'file_id')
+        labels = fid.select_column(WELLS_ANNOTATIONS_KEY, 'well_label')
+        is_in_journal = file_ids.isin(self._journal_file_ids).to_numpy()
+        if is_in_journal.any():
+            annotations = AnnotationStore.from_dataframe(fid.select(
+                WELLS_ANNOTATIONS_KEY, where=np.flatnonzero(is_in_journal)))
+        else:
+            annotations = AnnotationStore()
+        n_unlabelled = (labels[~is_in_journal] == 0).groupby(
+            file_ids[~is_in_journal]).sum()
+        for file_id, n in n_unlabelled.items():
+            annotations.set_n_unlabelled(file_id, n)
+        self._unloaded_file_ids = set(n_unlabelled.index.tolist())
+        return annotations
+
+    def save(
+            self,
+            annotations,
+            nn_voting_mode,
+            filenames_df=None,
+            working_dir=None):
+        """
+        Append the changes in annotations since the last save to the
+        journal. Only pass filenames_df and working_dir if they changed
+        """
+        changes_df = annotations.get_changes()
+        # videos may be loading in the background
+        with HDF5_LOCK:
+            if len(changes_df) > 0:
+                changes_df['timestamp'] = time.time()
+                with pd.HDFStore(self.wellsanns_file, 'r+') as fid:
+                    fid.append(
+                        WELLS_ANNOTATIONS_JOURNAL_KEY,
+                        changes_df,
+                        index=False,
+                        min_itemsize={'well_name': WELL_NAME_ITEMSIZE})
+                self._n_journal_rows += len(changes_df)
+                self._journal_file_ids.update(changes_df['file_id'].tolist())
+                annotations.mark_saved()
+            if filenames_df is not None:
+                filenames_df.to_hdf(
+                    self.wellsanns_file,
+                    key='/filenames_df',
+                    index=False,
+                    mode='r+')
+            with h5py.File(self.wellsanns_file, 'r+') as fid:
+                # add working_dir (lost if filenames_df was rewritten)
+                if filenames_df is not None:
+                    fid["/filenames_df"].attrs["working_dir"] = str(
+                        working_dir)
+                # add nn_voting_mode
+                if nn_voting_mode != self._saved_nn_voting_mode:
+                    fid["/wells_annotations_df"].attrs["nn_voting_mode"] = (
+                        nn_voting_mode)
+                    self._saved_nn_voting_mode = nn_voting_mode
+            if self._n_journal_rows > self.journal_max_rows:
+                self._compact()
+
+    def compact(self, annotations, nn_voting_mode):
+        """
+        Merge the journal into /wells_annotations_df.
+        Only what was saved is merged, unsaved changes in annotations
+        are not written
+        """
+        with HDF5_LOCK:
+            if self._n_journal_rows > 0:
+                self._compact()
+
+    def _compact(self):
+        """
+        Replay the journal on the wells of its files in
+        /wells_annotations_df, write them back and delete the journal.
+        Only reads from disk. Call with HDF5_LOCK held
+        """
+        with pd.HDFStore(self.wellsanns_file, 'r+') as fid:
+            journal_df = fid[WELLS_ANNOTATIONS_JOURNAL_KEY]
+            if fid.get_storer(WELLS_ANNOTATIONS_KEY).is_table:
+                # replace the wells of the changed files only
+                changed_file_ids = sorted(set(
+                    journal_df['file_id'].astype(int).tolist()))
+                saved_df = pd.concat(
+                    [fid.select(
+                        WELLS_ANNOTATIONS_KEY,
+                        where=f'file_id == {file_id}')
+                     for file_id in changed_file_ids],
+                    ignore_index=True)
+                merged = AnnotationStore.from_dataframe(
+                    saved_df[WELLS_ANNOTATIONS_DF_COLS])
+                merged.apply_changes(journal_df[WELLS_ANNOTATIONS_DF_COLS])
+                for file_id in changed_file_ids:
+                    fid.remove(
+                        WELLS_ANNOTATIONS_KEY,
+                        where=f'file_id == {file_id}')
+                fid.append(
+                    WELLS_ANNOTATIONS_KEY,
+                    merged.to_dataframe(),
+                    **WELLS_ANNOTATIONS_TABLE_KWARGS)
+            else:
+                # first time, rewrite the whole table in table format
+                merged = AnnotationStore.from_dataframe(
+                    fid[WELLS_ANNOTATIONS_KEY])
+                merged.apply_changes(journal_df[WELLS_ANNOTATIONS_DF_COLS])
+                fid.put(
+                    WELLS_ANNOTATIONS_KEY,
+                    merged.to_dataframe(),
+                    format='table',
+                    **WELLS_ANNOTATIONS_TABLE_KWARGS)
+            fid.remove(WELLS_ANNOTATIONS_JOURNAL_KEY)
+        self._n_journal_rows = 0
+        self._journal_file_ids = set()
+        # rewriting the table loses its attributes
+        with h5py.File(self.wellsanns_file, 'r+') as fid:
+            fid["/wells_annotations_df"].attrs["nn_voting_mode"] = str(
+                self._saved_nn_voting_mode)
+        self._repack()
+
+    def _repack(self):
+        """
+        Removing rows and nodes does not make an hdf5 file any smaller:
+        copy what's left to a new file and swap it in (like ptrepack).
+        Call with HDF5_LOCK held
+        """
+        fd, tmp_path = tempfile.mkstemp(
+            suffix='.tmp',
+            prefix=self.wellsanns_file.name + '.',
+            dir=self.wellsanns_file.parent)
+        os.close(fd)
+        try:
+            with tables.open_file(self.wellsanns_file, 'r') as fid:
+                fid.copy_file(tmp_path, overwrite=True, propindexes=True)
+            # the copy turns the attributes we set with h5py into bytes
+            with h5py.File(tmp_path, 'r+') as fid:
+                for node, attr in [('/filenames_df', 'working_dir'),
+                                   ('/wells_annotations_df', 'nn_voting_mode')]:
+                    value = fid[node].attrs.get(attr)
+                    if isinstance(value, bytes):
+                        fid[node].attrs[attr] = value.decode()
+            os.replace(tmp_path, self.wellsanns_file)
+        except OSError as e:
+            print(f'Could not repack {self.wellsanns_file}: {e!r}')
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def read_file(self, file_id):
+        """
+        Wells of file_id, if they have not been read yet.
+        None if they have (nobody else writes to the file, so what's in
+        memory is up to date)
+        """
+        if file_id not in self._unloaded_file_ids:
+            return None
+        with HDF5_LOCK, pd.HDFStore(self.wellsanns_file, 'r') as fid:
+            file_df = fid.select(
+                WELLS_ANNOTATIONS_KEY, where=f'file_id == {int(file_id)}')
+        self._unloaded_file_ids.discard(file_id)
+        return file_df[WELLS_ANNOTATIONS_DF_COLS]
+
+    def read_unloaded(self):
+        """Wells of all the files not read yet, None if there are none"""
+        if len(self._unloaded_file_ids) == 0:
+            return None
+        with HDF5_LOCK, pd.HDFStore(self.wellsanns_file, 'r') as fid:
+            wells_df = fid.select(WELLS_ANNOTATIONS_KEY)
+        wells_df = wells_df[wells_df['file_id'].isin(self._unloaded_file_ids)]
+        self._unloaded_file_ids = set()
+        return wells_df[WELLS_ANNOTATIONS_DF_COLS]
+
+    # single user, so claiming files always works
+    def claim_file(self, file_id):
+        return None
+
+    def release_file(self, file_id):
+        return
+
+    def claimed_by_others(self):
+        return set()
+
+    def close(self):
+        return
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS filenames (
+    file_id INTEGER PRIMARY KEY,
+    filename TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS wells (
+    file_id INTEGER NOT NULL,
+    well_name TEXT NOT NULL,
+    x_min INTEGER,
+    x_max INTEGER,
+    y_min INTEGER,
+    y_max INTEGER,
+    PRIMARY KEY (file_id, well_name)
+);
+CREATE TABLE IF NOT EXISTS labels (
+    file_id INTEGER NOT NULL,
+    well_name TEXT NOT NULL,
+    annotator TEXT NOT NULL,
+    well_label INTEGER NOT NULL,
+    timestamp REAL NOT NULL,
+    PRIMARY KEY (file_id, well_name, annotator)
+);
+CREATE TABLE IF NOT EXISTS leases (
+    file_id INTEGER PRIMARY KEY,
+    annotator TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+"""
+
+
+class SQLiteAnnotationBackend(object):
+    """
+    Annotations in a *_wells_annotations.sqlite database, that several GUIs
+    can use at the same time.
+    Each annotator's labels are stored separately, and a well takes the
+    most recent label any annotator gave it.
+    While working on a file, an annotator holds a lease on it for lease_s
+    seconds (renewed at each save) so the others can skip it
+    """
+
+    def __init__(self, db_file, annotator=None, lease_s=1800):
+        self.db_file = Path(db_file)
+        self.annotator = (
+            get_annotator_name() if annotator is None else annotator)
+        self.lease_s = lease_s
+        self._claimed_file_ids = set()
+        # wait for other annotators' transactions rather than failing
+        self._con = sqlite3.connect(str(self.db_file), timeout=30)
+        # readers don't block the writer, and vice versa
+        self._con.execute('PRAGMA journal_mode=WAL')
+        self._con.execute('PRAGMA synchronous=NORMAL')
+        self._con.executescript(SQLITE_SCHEMA)
+
+    def _get_metadata(self, key, default=None):
+        row = self._con.execute(
+            'SELECT value FROM metadata WHERE key = ?', (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def _set_metadata(self, key, value):
+        self._con.execute(
+            'INSERT INTO metadata (key, value) VALUES (?, ?) '
+            'ON CONFLICT(key) DO UPDATE SET value = excluded.value',
+            (key, str(value)))
+
+    def read_wells(self, file_id=None, annotator=None):
+        """
+        Wells (of file_id, or all of them) in the order they were added,
+        with the latest label (of annotator, or of anyone)
+        """
+        labels_filter = '' if annotator is None else 'WHERE annotator = ?'
+        wells_filter = '' if file_id is None else 'WHERE w.file_id = ?'
+        params = [pp for pp in [annotator, file_id] if pp is not None]
+        # sqlite takes the bare well_label from the row with max(timestamp)
+        query = f"""
+            SELECT w.file_id, w.well_name, w.x_min, w.x_max, w.y_min,
+                w.y_max, COALESCE(l.well_label, 0) AS well_label
+            FROM wells AS w
+            LEFT JOIN (
+                SELECT file_id, well_name, well_label, MAX(timestamp)
+                FROM labels {labels_filter}
+                GROUP BY file_id, well_name
+                ) AS l
+            USING (file_id, well_name)
+            {wells_filter}
+            ORDER BY w.rowid
+            """
+        wells_df = pd.read_sql_query(query, self._con, params=params)
+        return wells_df[WELLS_ANNOTATIONS_DF_COLS]
+
+    def load(self):
+        filenames_df = pd.read_sql_query(
+            'SELECT file_id, filename FROM filenames ORDER BY file_id',
+            self._con)
+        working_dir = Path(self._get_metadata('working_dir'))
+        nn_voting_mode = self._get_metadata('nn_voting_mode', 'mode')
+        annotations = AnnotationStore.from_dataframe(self.read_wells())
+        return filenames_df, working_dir, annotations, nn_voting_mode
+
+    def save(
+            self,
+            annotations,
+            nn_voting_mode,
+            filenames_df=None,
+            working_dir=None):
+        """
+        Insert the wells added since the last save, and upsert the labels
+        set since then under this annotator.
+        Only pass filenames_df and working_dir if they changed
+        """
+        changes_df = annotations.get_changes()
+        # wells only added keep whatever label the others gave them
+        labelled_df = annotations.get_labelled_changes()
+        now = time.time()
+        # one transaction
+        with self._con:
+            if filenames_df is not None:
+                self._con.executemany(
+                    'INSERT INTO filenames (file_id, filename) '
+                    'VALUES (?, ?) '
+                    'ON CONFLICT(file_id) '
+                    'DO UPDATE SET filename = excluded.filename',
+                    zip(*[filenames_df[col].tolist()
+                          for col in FILES_DF_COLS]))
+                self._set_metadata('working_dir', working_dir)
+            self._set_metadata('nn_voting_mode', nn_voting_mode)
+            self._con.executemany(
+                'INSERT INTO wells '
+                '(file_id, well_name, x_min, x_max, y_min, y_max) '
+                'VALUES (?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT(file_id, well_name) DO NOTHING',
+                zip(*[changes_df[col].tolist()
+                      for col in WELLS_ANNOTATIONS_DF_COLS[:-1]]))
+            self._con.executemany(
+                'INSERT INTO labels '
+                '(file_id, well_name, annotator, well_label, timestamp) '
+                'VALUES (?, ?, ?, ?, ?) '
+                'ON CONFLICT(file_id, well_name, annotator) '
+                'DO UPDATE SET well_label = excluded.well_label, '
+                'timestamp = excluded.timestamp',
+                [(file_id, well_name, self.annotator, label, now)
+                 for file_id, well_name, label in zip(
+                     labelled_df['file_id'].tolist(),
+                     labelled_df['well_name'].tolist(),
+                     labelled_df['well_label'].tolist())])
+            # still working on these
+            self._con.execute(
+                'UPDATE leases SET expires = ? WHERE annotator = ?',
+                (now + self.lease_s, self.annotator))
+        annotations.mark_saved()
+
+    def compact(self, annotations, nn_voting_mode):
+        """Move the write-ahead log into the database. Save first"""
+        self._con.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def read_file(self, file_id):
+        """Latest labels of the wells of file_id in the database"""
+        return self.read_wells(file_id=file_id)
+
+    def read_unloaded(self):
+        # load() reads all the wells
+        return None
+
+    def claim_file(self, file_id):
+        """
+        Take (or renew) the lease on file_id, unless someone else holds it.
+        Return None if successful, or the name of who's holding it
+        """
+        now = time.time()
+        with self._con:
+            self._con.execute(
+                'INSERT INTO leases (file_id, annotator, expires) '
+                'VALUES (?, ?, ?) '
+                'ON CONFLICT(file_id) DO UPDATE '
+                'SET annotator = excluded.annotator, '
+                'expires = excluded.expires '
+                'WHERE leases.annotator = excluded.annotator '
+                'OR leases.expires < ?',
+                (file_id, self.annotator, now + self.lease_s, now))
+            (holder,) = self._con.execute(
+                'SELECT annotator FROM leases WHERE file_id = ?',
+                (file_id,)).fetchone()
+        if holder != self.annotator:
+            return holder
+        self._claimed_file_ids.add(file_id)
+        return None
+
+    def release_file(self, file_id):
+        with self._con:
+            self._con.execute(
+                'DELETE FROM leases WHERE file_id = ? AND annotator = ?',
+                (file_id, self.annotator))
+        self._claimed_file_ids.discard(file_id)
+
+    def claimed_by_others(self):
+        """file_ids that other annotators are working on"""
+        rows = self._con.execute(
+            'SELECT file_id FROM leases '
+            'WHERE annotator != ? AND expires >= ?',
+            (self.annotator, time.time())).fetchall()
+        return {row[0] for row in rows}
+
+    def close(self):
+        for file_id in list(self._claimed_file_ids):
+            self.release_file(file_id)
+        self._con.close()
+
+
+def _hdf5_to_sqlite(
+        wells_annotations_filename, sqlite_filename=None,
+        annotator='imported'):
+    """
+    Copy a wells annotations hdf5 file to a new sqlite database, all the
+    labels attributed to `annotator`.
+    The database is named as the hdf5 file if sqlite_filename is None
+    """
+    wells_annotations_filename = Path(wells_annotations_filename)
+    if sqlite_filename is None:
+        sqlite_filename = wells_annotations_filename.with_name(
+            wells_annotations_filename.name.replace(
+                WELLS_ANNOTATION_EXT, WELLS_ANNOTATION_SQLITE_EXT))
+    sqlite_filename = Path(sqlite_filename)
+    assert sqlite_filename.name.endswith(WELLS_ANNOTATION_SQLITE_EXT), (
+        f'The database name should end in {WELLS_ANNOTATION_SQLITE_EXT}')
+    assert not sqlite_filename.exists(), f'{sqlite_filename} already exists'
+
+    src = HDF5AnnotationBackend(wells_annotations_filename)
+    filenames_df, working_dir, annotations, nn_voting_mode = src.load()
+    saved_df = src.read_unloaded()
+    if saved_df is not None:
+        annotations.merge_saved(saved_df)
+    # write all the rows, not just the changes
+    annotations = AnnotationStore.from_dataframe(
+        annotations.to_dataframe(), is_saved=False)
+    db = SQLiteAnnotationBackend(sqlite_filename, annotator=annotator)
+    db.save(
+        annotations,
+        nn_voting_mode,
+        filenames_df=filenames_df,
+        working_dir=working_dir)
+    db.close()
+    print(f'Annotations copied to {sqlite_filename}')
+
+    return sqlite_filename
+
+
+def _sqlite_to_hdf5(
+        sqlite_filename, wells_annotations_filename, annotator=None):
+    """
+    Write the annotations in a sqlite database to a new hdf5 file.
+    Use the latest label of each well, or only the labels of `annotator`
+    """
+    sqlite_filename = Path(sqlite_filename)
+    wells_annotations_filename = Path(wells_annotations_filename)
+    assert sqlite_filename.exists(), f'{sqlite_filename} not found'
+    assert wells_annotations_filename.name.endswith(WELLS_ANNOTATION_EXT), (
+        f'The hdf5 file name should end in {WELLS_ANNOTATION_EXT}')
+    assert not wells_annotations_filename.exists(), (
+        f'{wells_annotations_filename} already exists')
+
+    db = SQLiteAnnotationBackend(sqlite_filename)
+    filenames_df, working_dir, _, nn_voting_mode = db.load()
+    wells_annotations_df = db.read_wells(annotator=annotator)
+    db.close()
+
+    filenames_df.to_hdf(
+        wells_annotations_filename,
+        key='/filenames_df',
+        index=False,
+        mode='w')
+    wells_annotations_df.to_hdf(
+        wells_annotations_filename,
+        key='/wells_annotations_df',
+        index=False,
+        mode='r+')
+    with h5py.File(wells_annotations_filename, 'r+') as fid:
+        fid["/filenames_df"].attrs["working_dir"] = str(working_dir)
+        fid["/wells_annotations_df"].attrs["nn_voting_mode"] = (
+            nn_voting_mode)
+    print(f'Annotations copied to {wells_annotations_filename}')
+
+    return wells_annotations_filename
+
+
+def annotations_to_sqlite():
+    """
+    annotations_to_sqlite Copy a wells annotations hdf5 file to a sqlite
+        database, that several people can annotate at the same time
+        (each running their own well_annotator).
+
+    Parameters
+    ----------
+    wells_annotations_filename : Path
+        Path to the annotations hdf5 file
+    sqlite_filename : Path, optional
+        Path to the new database. Defaults to the hdf5 file's path, ending
+        in _wells_annotations.sqlite
+    annotator : str, optional
+        Name the existing labels are attributed to. Defaults to "imported"
+    """
+    import fire
+
+    fire.Fire(_hdf5_to_sqlite)
+
+
+def annotations_to_hdf5():
+    """
+    annotations_to_hdf5 Copy the annotations in a sqlite database to a new
+        wells annotations hdf5 file.
+
+    Parameters
+    ----------
+    sqlite_filename : Path
+        Path to the annotations database
+    wells_annotations_filename : Path
+        Path to the new hdf5 file, needs to end in _wells_annotations.hdf5
+    annotator : str, optional
+        Only export this annotator's labels. By default, each well takes
+        the latest label it was given by anyone
+    """
+    import fire
+
+    fire.Fire(_sqlite_to_hdf5)
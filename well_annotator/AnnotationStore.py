@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Mar 21 10:14:52 2022
+
+@author: lferiani
+
+In-memory store of the wells annotations of a project, kept in numpy arrays
+rather than in a DataFrame that needs to be appended to
+"""
+
+import bisect
+import numpy as np
+import pandas as pd
+
+from well_annotator.helper import WELLS_ANNOTATIONS_DF_COLS
+
+
+BOUNDS_COLS = ['x_min', 'x_max', 'y_min', 'y_max']
+
+
+class AnnotationStore(object):
+    """
+    Columnar store of the wells annotations.
+    All the wells of a file are stored in consecutive rows, in the order
+    they were added, so each file_id maps to a range of rows.
+    Well names are stored as integer codes into self.well_categories.
+    A review index (number of unlabelled wells per file, and a sorted list
+    of the file_ids with unlabelled wells or not seen yet) is kept up to
+    date as labels change.
+    Rows changed since the last call to mark_saved are tracked, so that
+    only those need to be written to disk. Of these, the rows whose label
+    was set (rather than just added with the file) are tracked too, as
+    they are the only ones with labels by this annotator.
+    """
+
+    def __init__(self, capacity=1024):
+        self._n_rows = 0
+        self.file_id = np.empty(capacity, dtype=np.int64)
+        self.well_code = np.empty(capacity, dtype=np.int32)
+        self.bounds = np.empty((capacity, len(BOUNDS_COLS)), dtype=np.int64)
+        self.well_label = np.empty(capacity, dtype=np.int8)
+        # well name <-> code
+        self.well_categories = []
+        self._well_codes = {}
+        # file_id -> (first row, last row + 1)
+        self._file_rows = {}
+        # (file_id, well_name) -> row
+        self._row_lut = {}
+        self._max_file_id = None
+        # review index
+        self._n_unlabelled = {}
+        # sorted, for bisect
+        self._pending_file_ids = []
+        # rows changed since last saved
+        self._changed_rows = set()
+        # rows labelled since last saved, a subset of the changed ones
+        self._labelled_rows = set()
+
+    def __len__(self):
+        return self._n_rows
+
+    @property
+    def labels(self):
+        """Read-only view of the labels of all stored wells"""
+        labels = self.well_label[:self._n_rows]
+        labels.flags.writeable = False
+        return labels
+
+    @property
+    def file_ids(self):
+        """Read-only view of the file_id of all stored wells"""
+        file_ids = self.file_id[:self._n_rows]
+        file_ids.flags.writeable = False
+        return file_ids
+
+    def _get_well_code(self, well_name):
+        if well_name not in self._well_codes:
+            self._well_codes[well_name] = len(self.well_categories)
+            self.well_categories.append(well_name)
+        return self._well_codes[well_name]
+
+    def _grow(self, min_capacity):
+        """Double the arrays' size until at least min_capacity"""
+        capacity = len(self.file_id)
+        if min_capacity <= capacity:
+            return
+        while capacity < min_capacity:
+            capacity *= 2
+        for attr in ['file_id', 'well_code', 'bounds', 'well_label']:
+            old = getattr(self, attr)
+            new = np.empty((capacity, *old.shape[1:]), dtype=old.dtype)
+            new[:self._n_rows] = old[:self._n_rows]
+            setattr(self, attr, new)
+
+    def has_file(self, file_id):
+        return file_id in self._file_rows
+
+    def stored_file_ids(self):
+        """file_ids with annotations in the store, in order of insertion"""
+        return list(self._file_rows.keys())
+
+    def max_file_id(self):
+        return self._max_file_id
+
+    def get_rows(self, file_id):
+        """Range of rows with the wells of file_id"""
+        return range(*self._file_rows[file_id])
+
+    def _set_pending(self, file_id, is_pending):
+        """Add file_id to, or remove it from, the sorted pending file_ids"""
+        ind = bisect.bisect_left(self._pending_file_ids, file_id)
+        was_pending = (ind < len(self._pending_file_ids)
+                       and self._pending_file_ids[ind] == file_id)
+        if is_pending and not was_pending:
+            self._pending_file_ids.insert(ind, file_id)
+        elif not is_pending and was_pending:
+            del self._pending_file_ids[ind]
+
+    def _set_n_unlabelled(self, file_id, n_unlabelled):
+        """Update the review index for file_id"""
+        self._n_unlabelled[file_id] = n_unlabelled
+        self._set_pending(file_id, n_unlabelled > 0)
+
+    def register_files(self, file_ids):
+        """
+        Let the store know these files exist, so that they are counted as
+        needing review until their wells are added and labelled
+        """
+        for file_id in file_ids:
+            file_id = int(file_id)
+            if file_id in self._n_unlabelled:
+                continue
+            self._n_unlabelled[file_id] = None
+            self._set_pending(file_id, True)
+
+    def set_n_unlabelled(self, file_id, n_unlabelled):
+        """
+        Count the unlabelled wells of a file whose wells are not in the
+        store (yet), e.g. because they have not been read from disk
+        """
+        assert not self.has_file(file_id), f'file_id {file_id} already in'
+        self._set_n_unlabelled(int(file_id), int(n_unlabelled))
+
+    def pending_file_ids(self):
+        """Sorted file_ids with unlabelled wells, or not seen yet"""
+        return list(self._pending_file_ids)
+
+    def n_unlabelled(self, file_id):
+        """Number of unlabelled wells in file_id, None if not seen yet"""
+        return self._n_unlabelled.get(file_id)
+
+    def next_pending_file(self, file_id):
+        """
+        First file after file_id that needs review, restarting from the
+        beginning if there are none after file_id. None if all done.
+        """
+        if not self._pending_file_ids:
+            return None
+        ind = bisect.bisect_right(self._pending_file_ids, file_id)
+        if ind == len(self._pending_file_ids):
+            ind = 0
+        return self._pending_file_ids[ind]
+
+    def add_file(self, file_id, wells_df):
+        """
+        Add all the wells of a file.
+        wells_df needs to be indexed by well_name, and have columns
+        x_min, x_max, y_min, y_max, and (optionally) well_label
+        """
+        assert not self.has_file(file_id), f'file_id {file_id} already in'
+        n_wells = len(wells_df)
+        start = self._n_rows
+        stop = start + n_wells
+        self._grow(stop)
+
+        well_names = wells_df.index.to_list()
+        self.file_id[start:stop] = file_id
+        self.well_code[start:stop] = [
+            self._get_well_code(wn) for wn in well_names]
+        self.bounds[start:stop] = wells_df[BOUNDS_COLS].to_numpy()
+        if 'well_label' in wells_df:
+            self.well_label[start:stop] = wells_df['well_label'].to_numpy()
+        else:
+            self.well_label[start:stop] = 0
+
+        self._n_rows = stop
+        self._file_rows[file_id] = (start, stop)
+        if self._max_file_id is None or file_id > self._max_file_id:
+            self._max_file_id = file_id
+        self._row_lut.update(
+            ((file_id, wn), row)
+            for row, wn in zip(range(start, stop), well_names))
+        self._set_n_unlabelled(
+            file_id, int(np.sum(self.well_label[start:stop] == 0)))
+        self._changed_rows.update(range(start, stop))
+        self._labelled_rows.update(
+            (np.flatnonzero(self.well_label[start:stop]) + start).tolist())
+
+    def update_file(self, file_id, wells_df):
+        """
+        Overwrite the labels of all the wells of a file at once.
+        wells_df needs to be indexed by well_name and have column well_label
+        """
+        start, stop = self._file_rows[file_id]
+        # assumes wells order not to have changed
+        # since wells_df was first added. sounds reasonable enough
+        assert len(wells_df) == stop - start, 'number of wells not matching'
+        assert np.array_equal(
+            self.well_code[start:stop],
+            [self._well_codes.get(wn, -1) for wn in wells_df.index]
+            ), 'wells order not matching'
+        new_labels = wells_df['well_label'].to_numpy()
+        changed = np.flatnonzero(self.well_label[start:stop] != new_labels)
+        self._changed_rows.update((changed + start).tolist())
+        self._labelled_rows.update((changed + start).tolist())
+        self.well_label[start:stop] = new_labels
+        self._set_n_unlabelled(
+            file_id, int(np.sum(self.well_label[start:stop] == 0)))
+
+    def set_label(self, file_id, well_name, label):
+        """Change the label of a single well"""
+        row = self._row_lut[(file_id, well_name)]
+        delta = int(label == 0) - int(self.well_label[row] == 0)
+        if self.well_label[row] != label:
+            self._changed_rows.add(row)
+            self._labelled_rows.add(row)
+        self.well_label[row] = label
+        if delta != 0:
+            self._set_n_unlabelled(
+                file_id, self._n_unlabelled[file_id] + delta)
+
+    def get_label(self, file_id, well_name):
+        return int(self.well_label[self._row_lut[(file_id, well_name)]])
+
+    def get_file(self, file_id):
+        """
+        Return the wells of a file as a DataFrame indexed by well_name,
+        like the rows of to_dataframe() for this file
+        """
+        start, stop = self._file_rows[file_id]
+        return self._rows_to_dataframe(
+            slice(start, stop)).set_index('well_name')
+
+    def _rows_to_dataframe(self, rows):
+        df = pd.DataFrame({
+            'file_id': self.file_id[rows],
+            'well_name': np.array(
+                self.well_categories, dtype=object)[self.well_code[rows]],
+            })
+        for cc, col in enumerate(BOUNDS_COLS):
+            df[col] = self.bounds[rows, cc]
+        df['well_label'] = self.well_label[rows].astype(np.int64)
+        return df[WELLS_ANNOTATIONS_DF_COLS]
+
+    def to_dataframe(self):
+        """
+        Export the store as a DataFrame with columns WELLS_ANNOTATIONS_DF_COLS
+        """
+        return self._rows_to_dataframe(slice(0, self._n_rows))
+
+    def get_changes(self):
+        """
+        Return the rows changed since the last save as a DataFrame
+        (in the order they were stored). Call mark_saved once they have
+        been written, so they are not lost if writing fails
+        """
+        rows = np.array(sorted(self._changed_rows), dtype=np.int64)
+        return self._rows_to_dataframe(rows)
+
+    def get_labelled_changes(self):
+        """
+        Like get_changes, but only the rows whose label was set since the
+        last save, not the ones just added
+        """
+        rows = np.array(sorted(self._labelled_rows), dtype=np.int64)
+        return self._rows_to_dataframe(rows)
+
+    def mark_saved(self):
+        """Forget the changed rows, e.g. after writing the whole store"""
+        self._changed_rows = set()
+        self._labelled_rows = set()
+
+    @property
+    def n_changes(self):
+        return len(self._changed_rows)
+
+    def apply_changes(self, changes_df):
+        """
+        Replay rows with columns WELLS_ANNOTATIONS_DF_COLS on top of the
+        store, in order, the last row of each well wins.
+        Wells of files not in the store yet are added
+        """
+        for file_id, file_df in changes_df.groupby('file_id', sort=False):
+            file_id = int(file_id)
+            file_df = file_df.drop_duplicates(
+                subset='well_name', keep='last')
+            if not self.has_file(file_id):
+                # keep the order the wells were first added in
+                first_seen = changes_df.loc[
+                    changes_df['file_id'] == file_id, 'well_name'].unique()
+                self.add_file(
+                    file_id,
+                    file_df.set_index('well_name').loc[first_seen])
+            else:
+                for well_name, label in zip(
+                        file_df['well_name'], file_df['well_label']):
+                    self.set_label(file_id, well_name, label)
+
+    def merge_saved(self, saved_df):
+        """
+        Update the store with rows (columns WELLS_ANNOTATIONS_DF_COLS) read
+        back from disk, e.g. written there by another annotator.
+        Wells labelled since the last save keep their label, the others
+        are not marked as labelled
+        """
+        for file_id, file_df in saved_df.groupby('file_id', sort=False):
+            file_id = int(file_id)
+            if not self.has_file(file_id):
+                self.add_file(file_id, file_df.set_index('well_name'))
+                self._changed_rows.difference_update(self.get_rows(file_id))
+                self._labelled_rows.difference_update(self.get_rows(file_id))
+                continue
+            for well_name, label in zip(
+                    file_df['well_name'], file_df['well_label']):
+                row = self._row_lut.get((file_id, well_name))
+                if row is None or row in self._labelled_rows:
+                    continue
+                # wells only added since the last save still need saving
+                is_changed = row in self._changed_rows
+                self.set_label(file_id, well_name, label)
+                self._labelled_rows.discard(row)
+                if not is_changed:
+                    self._changed_rows.discard(row)
+
+    def snapshot(self):
+        """
+        Copy of the wells of the files with rows labelled since the last
+        save, that can be written to disk in another thread while the
+        store keeps changing. is_labelled marks the labelled rows
+        """
+        labelled_rows = np.array(sorted(self._labelled_rows), dtype=np.int64)
+        rows = [
+            np.arange(*self._file_rows[file_id])
+            for file_id in np.unique(self.file_id[labelled_rows]).tolist()]
+        rows = np.concatenate(rows) if rows else labelled_rows
+        return {
+            'file_id': self.file_id[rows],
+            'well_code': self.well_code[rows],
+            'bounds': self.bounds[rows],
+            'well_label': self.well_label[rows],
+            'is_labelled': np.isin(rows, labelled_rows),
+            'well_categories': np.array(self.well_categories, dtype=str),
+            }
+
+    @staticmethod
+    def snapshot_to_dataframe(snapshot):
+        """
+        Convert the output of snapshot() to a DataFrame with columns
+        WELLS_ANNOTATIONS_DF_COLS
+        """
+        df = pd.DataFrame({
+            'file_id': snapshot['file_id'].astype(np.int64),
+            'well_name': snapshot['well_categories'][
+                snapshot['well_code']].astype(object),
+            })
+        for cc, col in enumerate(BOUNDS_COLS):
+            df[col] = snapshot['bounds'][:, cc]
+        df['well_label'] = snapshot['well_label'].astype(np.int64)
+        return df[WELLS_ANNOTATIONS_DF_COLS]
+
+    def apply_snapshot(self, snapshot):
+        """
+        Replay the labelled rows of the output of snapshot() on top of the
+        store. Files not in the store are added with all their wells
+        """
+        snapshot_df = self.snapshot_to_dataframe(snapshot)
+        is_new_file = ~snapshot_df['file_id'].map(self.has_file)
+        self.apply_changes(
+            snapshot_df[is_new_file | snapshot['is_labelled']])
+
+    @classmethod
+    def from_dataframe(cls, wells_annotations_df, is_saved=True):
+        """
+        Build a store from a DataFrame with columns WELLS_ANNOTATIONS_DF_COLS.
+        If is_saved is False, all rows are marked as changed
+        """
+        store = cls(capacity=max(1024, len(wells_annotations_df)))
+        # keep the wells of each file in the order they were in the df
+        for file_id, file_df in wells_annotations_df.groupby(
+                'file_id', sort=False):
+            store.add_file(int(file_id), file_df.set_index('well_name'))
+        if is_saved:
+            # these are already on disk
+            store.mark_saved()
+        return store
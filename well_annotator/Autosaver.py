@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Mar 29 09:41:07 2022
+
+@author: lferiani
+
+Autosave snapshots of the annotations to a file next to the annotations
+file, from a background thread, some time after the last edit or after a
+number of edits. So a crash only loses the last few seconds of work
+"""
+
+import os
+import time
+import numpy as np
+from pathlib import Path
+
+from PyQt5.QtCore import QObject, QThread, QTimer, pyqtSignal
+
+
+def get_autosave_path(wellsanns_file, annotator=None):
+    """
+    *_wells_annotations.hdf5 -> *_wells_annotations.autosave.npz
+    or *_wells_annotations.<annotator>.autosave.npz if annotator is given
+    """
+    if annotator is None:
+        return Path(wellsanns_file).with_suffix('.autosave.npz')
+    return Path(wellsanns_file).with_suffix(f'.{annotator}.autosave.npz')
+
+
+def write_snapshot(path, snapshot):
+    """
+    Write a dict of arrays to a temporary file, then rename it to path,
+    so that path is never left half-written
+    """
+    path = Path(path)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'wb') as fid:
+        np.savez(fid, **snapshot)
+        fid.flush()
+        os.fsync(fid.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_snapshot(path):
+    with np.load(path, allow_pickle=False) as data:
+        return {key: data[key] for key in data.files}
+
+
+class SnapshotWriter(QThread):
+    """
+    Write a snapshot in the background.
+    done emits an error message, empty if the snapshot was written
+    """
+    done = pyqtSignal(str)
+
+    def __init__(self, path, snapshot, parent=None):
+        super().__init__(parent)
+        self.path = path
+        self.snapshot = snapshot
+
+    def run(self):
+        try:
+            write_snapshot(self.path, self.snapshot)
+            self.done.emit('')
+        except Exception as e:
+            self.done.emit(f'{e!r}')
+
+
+class Autosaver(QObject):
+    """
+    Call notify_edit() after each edit. After n_edits edits, or interval_ms
+    without any edit, take_snapshot() is called in the GUI thread (so it
+    should just copy the state), and its output is written to self.path in
+    a background thread.
+    status_changed emits a message to show the user
+    """
+    status_changed = pyqtSignal(str)
+
+    def __init__(
+            self, take_snapshot, interval_ms=5000, n_edits=20, parent=None):
+        super().__init__(parent)
+        self.take_snapshot = take_snapshot
+        self.interval_ms = interval_ms
+        self.n_edits = n_edits
+        self.path = None
+        self._n_edits = 0  # since the last snapshot
+        self._writer = None
+        self._is_pending = False  # edits while the writer was busy
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self.autosave)
+
+    def set_path(self, path):
+        """Start autosaving to path, None to stop autosaving"""
+        self.stop()
+        self.path = None if path is None else Path(path)
+
+    def notify_edit(self):
+        if self.path is None:
+            return
+        self._n_edits += 1
+        if self._n_edits >= self.n_edits:
+            self.autosave()
+        else:
+            # restart the countdown
+            self._timer.start(self.interval_ms)
+
+    def autosave(self):
+        self._timer.stop()
+        if self._n_edits == 0 or self.path is None:
+            return
+        if self._writer is not None and self._writer.isRunning():
+            # try again when the writer is done
+            self._is_pending = True
+            return
+        self._n_edits = 0
+        self._writer = SnapshotWriter(
+            self.path, self.take_snapshot(), parent=self)
+        self._writer.done.connect(self._on_written)
+        self.status_changed.emit('Autosaving...')
+        self._writer.start()
+
+    def _on_written(self, error_msg):
+        if self.sender() is not self._writer:
+            # discarded while writing
+            return
+        if error_msg:
+            print(f'Autosave to {self.path} failed: {error_msg}')
+            self.status_changed.emit('Autosave failed!')
+        else:
+            self.status_changed.emit(
+                f'Autosaved at {time.strftime("%H:%M:%S")}')
+        if self._is_pending:
+            self._is_pending = False
+            self.autosave()
+
+    def stop(self):
+        """Forget the edits not autosaved yet, wait for any running write"""
+        self._timer.stop()
+        self._n_edits = 0
+        self._is_pending = False
+        if self._writer is not None:
+            self._writer.wait()
+            self._writer = None
+
+    def flush(self):
+        """
+        Write the edits not autosaved yet now, in this thread, and keep the
+        autosaved file, e.g. when closing without saving
+        """
+        self._timer.stop()
+        self._is_pending = False
+        if self._writer is not None:
+            self._writer.wait()
+            self._writer = None
+        if self._n_edits == 0 or self.path is None:
+            return
+        self._n_edits = 0
+        try:
+            write_snapshot(self.path, self.take_snapshot())
+        except OSError as e:
+            print(f'Autosave to {self.path} failed: {e!r}')
+
+    def discard(self):
+        """
+        Stop autosaving the current edits and delete the autosaved file,
+        e.g. once the annotations have been saved
+        """
+        self.stop()
+        if self.path is not None and self.path.exists():
+            self.path.unlink()
@@ -4,11 +4,83 @@ import os
 import numpy as np
 import copy
 from functools import partial
+from collections import OrderedDict
 
 from PyQt5 import QtWidgets, QtCore, QtGui
 from PyQt5.QtCore import Qt
 from well_annotator.HDF5VideoPlayer_ui import Ui_HDF5VideoPlayer
 
+
+def get_contrast_limits(image_group, percentiles=None, max_sample_frames=50):
+    """
+    Get the range of the whole stack, or between the given percentiles
+    (e.g. (0.5, 99.5)), to stretch to 0-255 for display.
+    If the stack is not in memory (e.g. a pytables node), only read
+    max_sample_frames frames evenly spaced through it.
+    """
+    if not isinstance(image_group, np.ndarray):
+        tot_frames = image_group.shape[0]
+        if tot_frames > max_sample_frames:
+            idx = np.linspace(0, tot_frames - 1, max_sample_frames)
+            image_group = image_group[
+                np.unique(idx.round().astype(int)).tolist(), :, :]
+        else:
+            image_group = image_group[:]
+
+    if percentiles is None:
+        bot, top = np.min(image_group), np.max(image_group)
+    else:
+        bot, top = np.percentile(image_group, percentiles)
+
+    return float(bot), float(top)
+
+
+def get_contrast_lut(bot, top, dtype):
+    """
+    Look-up table mapping every value of a 8 or 16 bits integer dtype to
+    uint8, stretching [bot, top] to [0, 255].
+    Values are shifted by the dtype's minimum, so for signed dtypes the
+    table must be indexed with img - np.iinfo(dtype).min
+    Returns None for other dtypes
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind not in 'ui' or dtype.itemsize > 2:
+        return None
+    info = np.iinfo(dtype)
+    values = np.arange(info.min, info.max + 1, dtype=np.float64)
+    return normalise_to_uint8(values, bot, top)
+
+
+def normalise_to_uint8(img, bot, top):
+    """
+    Stretch [bot, top] to [0, 255], clip anything outside and cast to uint8
+    """
+    scale = 255. / max(top - bot, np.finfo(np.float32).eps)
+    out = (img - bot) * scale
+    np.clip(out, 0, 255, out=out)
+    return np.round(out).astype(np.uint8)
+
+
+def build_pyramid(img, n_levels=3, min_size=64):
+    """
+    Return [img, img at 1/2, img at 1/4, ...], up to n_levels images.
+    Each level is the mean of 2x2 blocks of the previous one, computed on
+    the last two axes so that img can be a frame or a stack.
+    Stops early if a level would be smaller than min_size.
+    """
+    pyramid = [img]
+    for _ in range(n_levels - 1):
+        prev = pyramid[-1]
+        height, width = prev.shape[-2] // 2, prev.shape[-1] // 2
+        if min(height, width) < min_size:
+            break
+        blocks = prev[..., :2*height, :2*width].reshape(
+            *prev.shape[:-2], height, 2, width, 2)
+        level = blocks.mean(axis=(-3, -1), dtype=np.float32)
+        pyramid.append(np.round(level).astype(prev.dtype))
+    return pyramid
+
+
 def setChildrenFocusPolicy(obj, policy):
     # recursively change the focus policy of all the objects in the widgets
     def recursiveSetChildFocusPolicy(parentQWidget):
@@ -40,6 +112,48 @@ class LineEditDragDrop():
                 self.update_fun(vfilename)
 
 
+class PixmapCache():
+    """
+    LRU cache of ready-to-display QPixmaps, e.g. keyed by
+    (video, well or h5path, frame number), holding up to max_size_mb
+    """
+
+    def __init__(self, max_size_mb=256):
+        self.max_nbytes = max_size_mb * 1024**2
+        self._pixmaps = OrderedDict()
+        self.nbytes = 0
+
+    @staticmethod
+    def _pixmap_nbytes(pixmap):
+        # also accepts a pyramid, i.e. a tuple of pixmaps
+        if isinstance(pixmap, (tuple, list)):
+            return sum(map(PixmapCache._pixmap_nbytes, pixmap))
+        return pixmap.width() * pixmap.height() * pixmap.depth() // 8
+
+    def __contains__(self, key):
+        return key in self._pixmaps
+
+    def get(self, key):
+        pixmap = self._pixmaps.get(key)
+        if pixmap is not None:
+            self._pixmaps.move_to_end(key)
+        return pixmap
+
+    def put(self, key, pixmap):
+        if key in self._pixmaps:
+            self.nbytes -= self._pixmap_nbytes(self._pixmaps.pop(key))
+        self._pixmaps[key] = pixmap
+        self.nbytes += self._pixmap_nbytes(pixmap)
+        # drop the least recently used, but always keep the last one
+        while self.nbytes > self.max_nbytes and len(self._pixmaps) > 1:
+            _, old_pixmap = self._pixmaps.popitem(last=False)
+            self.nbytes -= self._pixmap_nbytes(old_pixmap)
+
+    def clear(self):
+        self._pixmaps.clear()
+        self.nbytes = 0
+
+
 class ViewsWithZoom():
 
     def __init__(self, view):
@@ -51,6 +165,8 @@ class ViewsWithZoom():
 
         self._zoom = 0
         self._view.wheelEvent = self.zoomWheelEvent
+        # pixmaps at full, 1/2, 1/4... resolution
+        self._pyramid = []
 
     # zoom wheel
     def zoomWheelEvent(self, event):
@@ -101,6 +217,7 @@ class ViewsWithZoom():
         # Zoom in/out scaling
         if self._zoom > 0:
             self._view.scale(factor, factor)
+            self._updatePyramidLevel()
         # Fitting to view
         elif self._zoom == 0:
             self.zoomFitInView()
@@ -110,7 +227,8 @@ class ViewsWithZoom():
             self.zoomFitInView()
 
     def zoomFitInView(self):
-        rect = QtCore.QRectF(self._canvas.pixmap().rect())
+        # the canvas is scaled up when showing a reduced level
+        rect = self._canvas.sceneBoundingRect()
         if not rect.isNull():
             unity = self._view.transform().mapRect(QtCore.QRectF(0, 0, 1, 1))
             self._view.scale(1 / unity.width(), 1 / unity.height())
@@ -121,16 +239,46 @@ class ViewsWithZoom():
             self._view.scale(factor, factor)
             self._view.centerOn(rect.center())
             self._zoom = 0
+            self._updatePyramidLevel()
+
+    def _updatePyramidLevel(self):
+        """
+        Show the smallest level that still has at least one pixel
+        per screen pixel at the current zoom
+        """
+        if not self._pyramid:
+            return
+        view_scale = self._view.transform().m11()
+        level = 0
+        while (level + 1 < len(self._pyramid)
+               and 2 ** (level + 1) * view_scale <= 1):
+            level += 1
+        if self._canvas.pixmap().cacheKey() != (
+                self._pyramid[level].cacheKey()):
+            self._canvas.setPixmap(self._pyramid[level])
+            self._canvas.setScale(2 ** level)
 
     def cleanCanvas(self):
+        self._pyramid = []
+        self._canvas.setScale(1)
         self._canvas.setPixmap(QtGui.QPixmap())
 
     def setPixmap(self, frame_qimg=None):
+        """
+        Show a QImage, a QPixmap, or a pyramid of QPixmaps at decreasing
+        resolution (see build_pyramid)
+        """
         if frame_qimg is None:
             return
 
-        pixmap = QtGui.QPixmap.fromImage(frame_qimg)
-        self._canvas.setPixmap(pixmap)
+        if isinstance(frame_qimg, (tuple, list)):
+            self._pyramid = list(frame_qimg)
+        elif isinstance(frame_qimg, QtGui.QPixmap):
+            self._pyramid = [frame_qimg]
+        else:
+            self._pyramid = [QtGui.QPixmap.fromImage(frame_qimg)]
+        self._canvas.setPixmap(QtGui.QPixmap())
+        self._updatePyramidLevel()
 
 class SimplePlayer(QtWidgets.QMainWindow):
     def __init__(self, ui):
@@ -240,6 +388,28 @@ class HDF5VideoPlayerGUI(SimplePlayer):
         self.h5path = None
         self.frame_img = None
         self.frame_qimg = None
+        # None for min/max, or e.g. (0.5, 99.5) to stretch between these
+        # percentiles of the whole stack
+        self.contrast_percentiles = None
+        self.contrast_limits = None
+        self.contrast_lut = None
+        self.pixmap_cache = PixmapCache(max_size_mb=256)
+        # reduced resolutions of each frame, used when zoomed out
+        self.pyramid_levels = 3
+        # coalesce bursts of frame changes (e.g. dragging the slider) into
+        # at most one render per display refresh, showing the latest frame
+        self.render_timer = QtCore.QTimer()
+        self.render_timer.setSingleShot(True)
+        self.render_timer.setInterval(16)
+        self.render_timer.timeout.connect(self.updateImage)
+        # make pixmaps in advance a few frames at a time, between events,
+        # so the GUI stays responsive while the cache warms up
+        self.warm_chunk_size = 8
+        self._warm_queue = []
+        self.warm_timer = QtCore.QTimer()
+        self.warm_timer.setSingleShot(True)
+        self.warm_timer.setInterval(0)
+        self.warm_timer.timeout.connect(self._warmPixmapChunk)
 
         #default expected groups in the hdf5
         self.ui.comboBox_h5path.setItemText(0, "/mask")
@@ -295,13 +465,74 @@ class HDF5VideoPlayerGUI(SimplePlayer):
     def updateFrameNumber(self):
         self.frame_number = self.ui.spinBox_frame.value()
         self.ui.imageSlider.setValue(self.frame_number)
-        self.updateImage()
+        self.scheduleImageUpdate()
+
+    def scheduleImageUpdate(self):
+        # the render will use whatever frame_number is current by then,
+        # so requests arriving before it are simply dropped
+        if not self.render_timer.isActive():
+            self.render_timer.start()
 
     # update image: get the next frame_number, and resize it to fix in the GUI
     # area
     def updateImage(self):
-        self.readCurrentFrame()
-        self.mainImage.setPixmap(self.frame_qimg)
+        if self.image_group is None:
+            self.readCurrentFrame()
+            return
+        self.mainImage.setPixmap(self.getFramePixmap(self.frame_number))
+
+    def _pixmapKey(self, frame_number):
+        return (self.vfilename, self.h5path, frame_number)
+
+    def getFramePixmap(self, frame_number):
+        """
+        Get the frame ready for display from the cache, or make it.
+        Returns a pyramid of pixmaps at decreasing resolution
+        """
+        key = self._pixmapKey(frame_number)
+        pyramid = self.pixmap_cache.get(key)
+        if pyramid is None:
+            self.frame_img = self.image_group[frame_number, :, :]
+            self._normalizeImage()
+            pyramid = tuple(
+                QtGui.QPixmap.fromImage(self._convert2Qimg(level))
+                for level in build_pyramid(
+                    self.frame_img, n_levels=self.pyramid_levels))
+            self.pixmap_cache.put(key, pyramid)
+        return pyramid
+
+    def warmPixmapCache(self, frame_numbers=None):
+        """
+        Queue the pixmaps of these frames (default all) to be made in
+        advance, nearest to the current frame first.
+        Replaces whatever was still queued
+        """
+        self._warm_queue = []
+        if self.image_group is None:
+            return
+        if frame_numbers is None:
+            frame_numbers = range(self.image_group.shape[0])
+        # reversed, so the nearest frames are popped first
+        self._warm_queue = sorted(
+            frame_numbers, key=lambda x: abs(x - self.frame_number),
+            reverse=True)
+        self.warm_timer.start()
+
+    def _warmPixmapChunk(self):
+        n_done = 0
+        while self._warm_queue and n_done < self.warm_chunk_size:
+            if self.image_group is None:
+                self._warm_queue = []
+                return
+            frame_number = self._warm_queue.pop()
+            if frame_number >= self.image_group.shape[0]:
+                continue
+            if self._pixmapKey(frame_number) in self.pixmap_cache:
+                continue
+            self.getFramePixmap(frame_number)
+            n_done += 1
+        if self._warm_queue:
+            self.warm_timer.start()
 
     def readCurrentFrame(self):
         if self.image_group is None:
@@ -319,26 +550,47 @@ class HDF5VideoPlayerGUI(SimplePlayer):
         self.label_height = dd.height()
         self.label_width = dd.width()
 
-        # equalize and cast if it is not uint8
+        # equalize and cast if it is not uint8, using the stack's limits
         if self.frame_img.dtype != np.uint8:
-            top = np.max(self.frame_img)
-            bot = np.min(self.frame_img)
-
-            self.frame_img = (self.frame_img - bot) * 255. / (top - bot)
-            self.frame_img = np.round(self.frame_img).astype(np.uint8)
+            if self.contrast_limits is None:
+                self.updateContrast()
+            if self.contrast_lut is not None:
+                offset = np.iinfo(self.frame_img.dtype).min
+                if offset != 0:
+                    self.frame_img = self.frame_img.astype(np.int32) - offset
+                self.frame_img = self.contrast_lut[self.frame_img]
+            else:
+                self.frame_img = normalise_to_uint8(
+                    self.frame_img, *self.contrast_limits)
 
         self.frame_qimg = self._convert2Qimg(self.frame_img)
 
 
+    def updateContrast(self):
+        """
+        Compute the display normalisation once for the whole image group
+        """
+        self.contrast_limits = None
+        self.contrast_lut = None
+        if self.image_group is None or self.image_group.dtype == np.uint8:
+            return
+        self.contrast_limits = get_contrast_limits(
+            self.image_group, percentiles=self.contrast_percentiles)
+        self.contrast_lut = get_contrast_lut(
+            *self.contrast_limits, self.image_group.dtype)
+
     def _convert2Qimg(self, img):
+        # the QImage wraps the numpy buffer without copying it, so the
+        # QImage keeps a reference to its own buffer for as long as it lives.
+        # Only copies if the rows are not contiguous in memory
+        img = np.require(img, dtype=np.uint8, requirements='C')
         qimg = QtGui.QImage(
             img.data,
             img.shape[1],
             img.shape[0],
             img.strides[0],
-            QtGui.QImage.Format_Indexed8)
-        qimg = qimg.convertToFormat(
-            QtGui.QImage.Format_RGB32, QtCore.Qt.AutoColor)
+            QtGui.QImage.Format_Grayscale8)
+        qimg._buf = img
 
         return qimg
 
@@ -356,6 +608,7 @@ class HDF5VideoPlayerGUI(SimplePlayer):
             self.mainImage.cleanCanvas()
             self.fid = None
             self.image_group = None
+        self.pixmap_cache.clear()
 
         self.vfilename = vfilename
         self.ui.lineEdit_video.setText(self.vfilename)
@@ -435,6 +688,7 @@ class HDF5VideoPlayerGUI(SimplePlayer):
         self.tot_frames = self.image_group.shape[0]
         self.image_height = self.image_group.shape[1]
         self.image_width = self.image_group.shape[2]
+        self.updateContrast()
 
         self.ui.spinBox_frame.setMaximum(self.tot_frames - 1)
         self.ui.imageSlider.setMaximum(self.tot_frames - 1)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Mar  8 11:02:15 2022
+
+@author: lferiani
+
+Build an atlas of downsampled thumbnails of all the wells of a video,
+so that the whole plate can be shown as a single image
+"""
+
+import cv2
+import numpy as np
+
+from PyQt5.QtCore import QThread, pyqtSignal
+
+from well_annotator.HDF5VideoPlayer import (
+    get_contrast_limits, normalise_to_uint8)
+
+
+def _make_thumbnails(well_stack, thumb_size):
+    """
+    Resize all frames of a well to thumb_size x thumb_size at once,
+    using the frames as colour channels for cv2
+    """
+    if well_stack.dtype != np.uint8:
+        well_stack = normalise_to_uint8(
+            well_stack.astype(np.float64), *get_contrast_limits(well_stack))
+    n_frames = well_stack.shape[0]
+    thumbs = np.empty((n_frames, thumb_size, thumb_size), dtype=np.uint8)
+    # cv2 handles at most 512 channels
+    for first in range(0, n_frames, 512):
+        chunk = np.ascontiguousarray(
+            well_stack[first:first+512].transpose((1, 2, 0)))
+        resized = cv2.resize(
+            chunk, (thumb_size, thumb_size), interpolation=cv2.INTER_AREA)
+        # 2D if only one frame in the chunk
+        thumbs[first:first+512] = resized.reshape(
+            thumb_size, thumb_size, -1).transpose((2, 0, 1))
+    return thumbs
+
+
+def build_plate_atlas(tiles, wells_df, thumb_size=96, is_interrupted=None):
+    """
+    Arrange a thumbnail of each well in a grid, using the wells'
+    row and col.
+    Returns the atlas, a (n_frames, n_rows*thumb_size, n_cols*thumb_size)
+    uint8 array, and a dict of (well_name, (row, col)) in the atlas' grid.
+    is_interrupted is checked before reading each well, if it returns True
+    stop and return (None, None)
+    """
+    rows = wells_df['row'] - wells_df['row'].min()
+    cols = wells_df['col'] - wells_df['col'].min()
+    positions = {
+        well_name: (int(rows[well_name]), int(cols[well_name]))
+        for well_name in wells_df.index}
+
+    # lazy tiles can read a well without touching their cache
+    get_well = getattr(tiles, 'read_well', tiles.__getitem__)
+    stacks = {}
+    for well_name in positions:
+        if is_interrupted is not None and is_interrupted():
+            return None, None
+        stacks[well_name] = get_well(well_name)
+
+    n_frames = min(stack.shape[0] for stack in stacks.values())
+    atlas = np.zeros(
+        (n_frames,
+         (rows.max() + 1) * thumb_size,
+         (cols.max() + 1) * thumb_size),
+        dtype=np.uint8)
+    for well_name, (row, col) in positions.items():
+        atlas[
+            :,
+            row * thumb_size:(row + 1) * thumb_size,
+            col * thumb_size:(col + 1) * thumb_size
+            ] = _make_thumbnails(stacks[well_name][:n_frames], thumb_size)
+
+    return atlas, positions
+
+
+class PlateAtlasBuilder(QThread):
+    """
+    Build the atlas of a video in the background.
+    atlas_ready emits (key, atlas, positions), key identifies the video.
+    Stop it with requestInterruption() and wait() before releasing the tiles
+    """
+    atlas_ready = pyqtSignal(object, object, object)
+
+    def __init__(self, key, tiles, wells_df, thumb_size=96, parent=None):
+        super().__init__(parent)
+        self.key = key
+        self.tiles = tiles
+        self.wells_df = wells_df.copy()
+        self.thumb_size = thumb_size
+
+    def run(self):
+        atlas, positions = build_plate_atlas(
+            self.tiles,
+            self.wells_df,
+            thumb_size=self.thumb_size,
+            is_interrupted=self.isInterruptionRequested)
+        if atlas is not None:
+            self.atlas_ready.emit(self.key, atlas, positions)
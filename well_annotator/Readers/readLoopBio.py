@@ -6,30 +6,207 @@ Created on Fri Oct 14 16:56:55 2016
 @author: ajaver
 """
 
+import numpy as np
+import multiprocessing
+from pathlib import Path
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from well_annotator.Readers.videoInfo import VideoInfo
+
+# when two requested frames are at most this many frames apart,
+# decoding forward is cheaper than seeking
+MAX_DECODE_GAP = 50
+# how many (frame_number, timestamp) of the frames read to remember
+FRAMES_LOG_SIZE = 1000
+
+
+def _decode_frames(vid, positions, frame_numbers, chunks, out,
+                   max_decode_gap=MAX_DECODE_GAP):
+    """
+    Decode the requested frames of an open imgstore into out.
+    positions, frame_numbers and chunks describe the requested frames
+    (sorted) by their position in the store's index, frame number and chunk.
+    Each chunk is sought into once, then decoded forward dropping the
+    unwanted frames. If all requested frames are close enough, the whole
+    request is a single sequential scan with get_next_image.
+    Returns the list of (frame_number, frame_timestamp) decoded.
+    """
+    gaps = np.diff(positions)
+    is_sequential = len(gaps) == 0 or gaps.max() <= max_decode_gap
+    frames_read = []
+    for ii, (pos, fn, chunk_n) in enumerate(
+            zip(positions, frame_numbers, chunks)):
+        is_forward = (ii > 0) and (gaps[ii-1] <= max_decode_gap) and (
+            is_sequential or chunk_n == chunks[ii-1])
+        if is_forward:
+            for _ in range(gaps[ii-1]):
+                img, (frame_number, frame_timestamp) = vid.get_next_image()
+        else:
+            img, (frame_number, frame_timestamp) = vid.get_image(int(fn))
+        out[ii] = img
+        frames_read.append((frame_number, frame_timestamp))
+    return frames_read
+
+
+def _decode_chunk(video_file, positions, frame_numbers, chunks,
+                  frame_shape, dtype, max_decode_gap):
+    """
+    Worker function for the parallel reader: open the store on its own,
+    decode the requested frames of one chunk, return them as a stack.
+    """
+    import imgstore
+
+    vid = imgstore.new_for_filename(video_file)
+    try:
+        out = np.empty((len(positions),) + tuple(frame_shape), dtype=dtype)
+        frames_read = _decode_frames(
+            vid, positions, frame_numbers, chunks, out,
+            max_decode_gap=max_decode_gap)
+    finally:
+        vid.close()
+    return out, frames_read
+
+
+def make_decode_pool(n_workers):
+    """
+    Pool of processes to decode loopbio chunks in parallel.
+    Workers are spawned rather than forked, as forking a process that
+    runs threads (e.g. the GUI's) can deadlock
+    """
+    return ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=multiprocessing.get_context('spawn'))
+
+
+def probe_loopbio(video_file):
+    """
+    Read frame range, shape and dtype of an imgstore from its metadata.yaml
+    and the chunks' index files, without opening the store or decoding.
+    """
+    import yaml
+
+    video_file = Path(video_file)
+    with open(video_file, 'r') as fid:
+        store_md = yaml.safe_load(fid)['__store']
+
+    # each chunk has an index file named after the chunk number
+    frame_min = np.inf
+    frame_max = -np.inf
+    for index_file in video_file.parent.iterdir():
+        if not index_file.stem.isdigit():
+            continue
+        if index_file.suffix == '.npz':
+            with np.load(index_file) as index:
+                chunk_frames = index['frame_number']
+        elif index_file.suffix == '.yaml':
+            with open(index_file, 'r') as fid:
+                chunk_frames = yaml.safe_load(fid)['frame_number']
+        else:
+            continue
+        if len(chunk_frames) > 0:
+            frame_min = min(frame_min, int(np.min(chunk_frames)))
+            frame_max = max(frame_max, int(np.max(chunk_frames)))
+    if frame_max < frame_min:
+        raise OSError(f'No frames found in {video_file}')
+
+    return VideoInfo(
+        video_file=str(video_file),
+        first_frame=frame_min,
+        tot_frames=frame_max - frame_min + 1,
+        height=store_md['imgshape'][0],
+        width=store_md['imgshape'][1],
+        dtype=np.dtype(store_md['imgdtype']),
+        )
+
 
 class readLoopBio():
-    def __init__(self, video_file):
+    def __init__(self, video_file, max_decode_gap=MAX_DECODE_GAP,
+                 n_workers=0, max_memory_mb=1024, video_info=None,
+                 frames_log_size=FRAMES_LOG_SIZE, decode_pool=None):
         import imgstore
 
+        # shape and frame range come from the metadata, no need to decode
+        if video_info is None:
+            video_info = probe_loopbio(video_file)
+
+        self.first_frame = video_info.first_frame
+        self.frame_max = video_info.first_frame + video_info.tot_frames - 1
+        self.tot_frames = video_info.tot_frames  # deprecated
+        self.height = video_info.height
+        self.width = video_info.width
+        self.dtype = video_info.dtype
+
         self.vid = imgstore.new_for_filename(video_file)
+        self.video_file = video_file
+        # ring buffer with (frame_number, timestamp) of the last frames read
+        self._frames_log = np.full((frames_log_size, 2), np.nan)
+        self._n_frames_logged = 0
+        self._last_frame_read = None
+        self.max_decode_gap = max_decode_gap
+        # lookup frame_number -> (chunk, position in the store), lazy
+        self._index_frame_numbers = None
+        self._index_frame_times = None
+        self._index_chunks = None
+        self._is_chunk_index = False
+        # opt-in parallel decoding of different chunks. max_memory_mb caps
+        # the decoded frames in flight between the workers and this process.
+        # decode_pool (from make_decode_pool) is shared with other readers
+        # and not shut down on release, otherwise a pool of n_workers
+        # processes is started when needed
+        self.n_workers = n_workers
+        self.max_memory_mb = max_memory_mb
+        self._pool = decode_pool
+        self._is_own_pool = decode_pool is None
 
-        self.first_frame = self.vid.frame_min
-        self.frame_max = self.vid.frame_max
-        self.tot_frames = self.frame_max - self.first_frame + 1  # deprecated
+    def _log_frames_read(self, frames_read):
+        """
+        Add a list of (frame_number, timestamp) to the ring buffer,
+        overwriting the oldest entries
+        """
+        if len(frames_read) == 0:
+            return
+        self._last_frame_read = frames_read[-1][0]
+        log_size = len(self._frames_log)
+        if log_size == 0:
+            return
+        to_log = np.asarray(frames_read, dtype=float)[-log_size:]
+        first = self._n_frames_logged + len(frames_read) - len(to_log)
+        idx = (first + np.arange(len(to_log))) % log_size
+        self._frames_log[idx] = to_log
+        self._n_frames_logged += len(frames_read)
 
-        img, (frame_number, frame_timestamp) = self.vid.get_next_image()
-        self.height = img.shape[0]
-        self.width = img.shape[1]
-        self.dtype = img.dtype
+    @property
+    def frames_read(self):
+        """
+        (n, 2) array with (frame_number, timestamp) of the last frames read,
+        oldest first. Only the last frames_log_size frames are kept.
+        """
+        log_size = len(self._frames_log)
+        n_logged = min(self._n_frames_logged, log_size)
+        idx = (self._n_frames_logged - n_logged + np.arange(n_logged))
+        return self._frames_log[idx % max(log_size, 1)]
 
-        self.vid.close()
-        self.vid = imgstore.new_for_filename(video_file)
-        self.frames_read = []
+    def get_timestamps(self, start=0, stop=None):
+        """
+        Read in bulk from the store's index the frame numbers and timestamps
+        of the frames start:stop (relative to the first frame),
+        without decoding them. Frames missing from the store are skipped.
+        """
+        if self._index_frame_numbers is None:
+            self._load_index()
+        start, stop, _ = slice(start, stop).indices(len(self))
+        first, last = np.searchsorted(
+            self._index_frame_numbers,
+            [self.first_frame + start, self.first_frame + stop])
+        return (self._index_frame_numbers[first:last],
+                self._index_frame_times[first:last])
 
     def read(self):
-        if not self.frames_read or self.frames_read[-1][0] < self.frame_max:
+        if (self._last_frame_read is None
+                or self._last_frame_read < self.frame_max):
             img, (frame_number, frame_timestamp) = self.vid.get_next_image()
-            self.frames_read.append((frame_number, frame_timestamp))
+            self._log_frames_read([(frame_number, frame_timestamp)])
             return 1, img
         else:
             return 0, None
@@ -39,13 +216,140 @@ class readLoopBio():
         if frame_to_read < self.frame_max:
             img, (frame_number, frame_timestamp) = self.vid.get_image(
                 frame_to_read)
-            self.frames_read.append((frame_number, frame_timestamp))
+            self._log_frames_read([(frame_number, frame_timestamp)])
             return 1, img
         else:
             return 0, None
 
+    def _load_index(self):
+        """
+        Build arrays with frame number, timestamp and chunk of every frame in
+        the store, in the order they are stored. Only reads the index.
+        The chunks come from imgstore's private per-chunk metadata. If this
+        version of imgstore does not have it, only the public
+        get_frame_metadata is used, and every frame is read on its own
+        """
+        frame_numbers = []
+        frame_times = []
+        chunks = []
+        try:
+            chunk_ns = self.vid.chunks
+            get_chunk_metadata = self.vid._get_chunk_metadata
+        except AttributeError:
+            frame_md = self.vid.get_frame_metadata()
+            frame_numbers = frame_md['frame_number']
+            frame_times = frame_md['frame_time']
+            # each frame in a chunk of its own: sought into, not decoded
+            # forward (unless all requested frames are close enough)
+            chunks = np.arange(len(frame_numbers))
+            self._is_chunk_index = False
+        else:
+            for chunk_n in chunk_ns:
+                chunk_md = get_chunk_metadata(chunk_n)
+                frame_numbers.extend(chunk_md['frame_number'])
+                frame_times.extend(chunk_md['frame_time'])
+                chunks.extend([chunk_n] * len(chunk_md['frame_number']))
+            self._is_chunk_index = True
+        self._index_frame_numbers = np.asarray(frame_numbers, dtype=np.int64)
+        self._index_frame_times = np.asarray(frame_times, dtype=float)
+        self._index_chunks = np.asarray(chunks, dtype=np.int64)
+
+    def read_frames(self, indices):
+        """
+        Read the frames at the given indices (relative to the first frame)
+        into a preallocated (n, height, width) array.
+        Indices are sorted, duplicates and frames missing from the store
+        are dropped. Requested frames are grouped by chunk so that each chunk
+        is decoded forward once instead of seeking for every frame.
+        """
+        if self._index_frame_numbers is None:
+            self._load_index()
+        indices = np.unique(np.asarray(indices, dtype=np.int64))
+        # find the requested frames in the store's index
+        frame_numbers = self.first_frame + indices
+        positions = np.searchsorted(self._index_frame_numbers, frame_numbers)
+        is_found = positions < len(self._index_frame_numbers)
+        # a missing frame points to the next frame in the store instead
+        is_found[is_found] = (
+            self._index_frame_numbers[positions[is_found]]
+            == frame_numbers[is_found])
+        positions = positions[is_found]
+
+        out = np.empty(
+            (len(positions), self.height, self.width), dtype=self.dtype)
+        chunks = self._index_chunks[positions]
+        is_parallel = (self.n_workers > 1) or not self._is_own_pool
+        if (is_parallel and self._is_chunk_index
+                and len(np.unique(chunks)) > 1):
+            frames_read = self._decode_frames_parallel(positions, out)
+        else:
+            frames_read = _decode_frames(
+                self.vid,
+                positions,
+                self._index_frame_numbers[positions],
+                chunks,
+                out,
+                max_decode_gap=self.max_decode_gap)
+        self._log_frames_read(frames_read)
+        return out
+
+    def _decode_frames_parallel(self, positions, out):
+        """
+        Farm out the decoding of each chunk to a pool of processes, and copy
+        the results in order in out as they come back.
+        Chunks are only submitted while the frames in flight fit in
+        max_memory_mb.
+        """
+        if self._pool is None:
+            self._pool = make_decode_pool(self.n_workers)
+
+        frame_bytes = self.height * self.width * np.dtype(self.dtype).itemsize
+        max_frames_in_flight = max(
+            1, int(self.max_memory_mb * 2**20 // frame_bytes))
+
+        chunks = self._index_chunks[positions]
+        is_new_chunk = np.flatnonzero(np.diff(chunks)) + 1
+        groups = np.split(np.arange(len(positions)), is_new_chunk)
+
+        frames_read = []
+        in_flight = deque()
+        n_in_flight = 0
+
+        def _collect_oldest():
+            group, future = in_flight.popleft()
+            out[group], group_frames_read = future.result()
+            frames_read.extend(group_frames_read)
+            return len(group)
+
+        for group in groups:
+            while in_flight and (
+                    n_in_flight + len(group) > max_frames_in_flight):
+                n_in_flight -= _collect_oldest()
+            future = self._pool.submit(
+                _decode_chunk,
+                self.video_file,
+                positions[group],
+                self._index_frame_numbers[positions[group]],
+                chunks[group],
+                (self.height, self.width),
+                self.dtype,
+                self.max_decode_gap)
+            in_flight.append((group, future))
+            n_in_flight += len(group)
+        while in_flight:
+            n_in_flight -= _collect_oldest()
+
+        return frames_read
+
+    def read_strided(self, start=0, stop=None, step=1):
+        start, stop, step = slice(start, stop, step).indices(len(self))
+        return self.read_frames(range(start, stop, step))
+
     def __len__(self):
-        return self.frame_max - self.first_frame + 1
+        return int(self.frame_max - self.first_frame + 1)
 
     def release(self):
+        if self._is_own_pool and self._pool is not None:
+            self._pool.shutdown()
+        self._pool = None
         return self.vid.close()
@@ -7,10 +7,36 @@ Created on Sun Oct  4 14:33:18 2015
 import tables
 import numpy as np
 
+from well_annotator.Readers.videoInfo import VideoInfo
+
+
+def probe_videoHDF5(fileName, dataset='/full_data'):
+    """
+    Read number of frames, shape and dtype of a video dataset from the node's
+    metadata, without reading any pixel.
+    """
+    try:
+        with tables.File(fileName, 'r') as fid:
+            node = fid.get_node(dataset)
+            tot_frames, height, width = map(int, node.shape)
+            dtype = node.dtype
+    except:
+        raise OSError
+
+    return VideoInfo(
+        video_file=fileName,
+        first_frame=0,
+        tot_frames=tot_frames,
+        height=height,
+        width=width,
+        dtype=dtype,
+        )
+
 
 class readVideoHDF5:
 
-    def __init__(self, fileName, full_img_period=np.inf, dataset='/mask'):
+    def __init__(self, fileName, full_img_period=np.inf, dataset='/mask',
+                 video_info=None):
         # to be used when added to the plugin
         self.vid_frame_pos = []
         self.vid_time_pos = []
@@ -21,11 +47,14 @@ class readVideoHDF5:
         except:
             raise OSError
 
-        self.tot_frames = self.dataset.shape[0]
+        if video_info is None:
+            video_info = VideoInfo(
+                fileName, 0, *self.dataset.shape, self.dataset.dtype)
+        self.tot_frames = video_info.tot_frames
 
-        self.width = self.dataset.shape[2]
-        self.height = self.dataset.shape[1]
-        self.dtype = self.dataset.dtype
+        self.width = video_info.width
+        self.height = video_info.height
+        self.dtype = video_info.dtype
 
         self.tot_pix = self.height * self.width
 
@@ -56,6 +85,60 @@ class readVideoHDF5:
 
         return self.read()
 
+    def read_strided(self, start=0, stop=None, step=1):
+        """
+        Read frames start:stop:step as a single hyperslab, straight into a
+        preallocated (n, height, width) array.
+        Frames are returned as stored in the dataset (no background filling).
+        """
+        start, stop, step = slice(start, stop, step).indices(self.tot_frames)
+        n_frames = len(range(start, stop, step))
+        out = np.empty((n_frames, self.height, self.width), dtype=self.dtype)
+        if n_frames > 0:
+            self.dataset.read(start, stop, step, out=out)
+        return out
+
+    def read_strided_roi(self, start, stop, step, y_min, y_max, x_min, x_max):
+        """
+        Read only the region [y_min:y_max, x_min:x_max] of the frames
+        start:stop:step, as a single hyperslab.
+        The parts of the region outside of the frame are filled by
+        replicating the pixels at the frame's edge.
+        """
+        start, stop, step = slice(start, stop, step).indices(self.tot_frames)
+        # clip the region to the frame, keeping at least one pixel
+        y_0 = min(max(y_min, 0), self.height - 1)
+        y_1 = max(min(y_max, self.height), y_0 + 1)
+        x_0 = min(max(x_min, 0), self.width - 1)
+        x_1 = max(min(x_max, self.width), x_0 + 1)
+        roi = self.dataset[start:stop:step, y_0:y_1, x_0:x_1]
+        pad_width = (
+            (0, 0),
+            (max(y_0 - y_min, 0), max(y_max - y_1, 0)),
+            (max(x_0 - x_min, 0), max(x_max - x_1, 0)),
+            )
+        if any(p > 0 for pw in pad_width for p in pw) and roi.shape[0] > 0:
+            roi = np.pad(roi, pad_width, mode='edge')
+        return roi
+
+    def read_frames(self, indices):
+        """
+        Read the frames at the given indices with one coordinate read.
+        Indices are sorted, duplicates and out-of-range ones are dropped.
+        Returns a (n, height, width) array.
+        """
+        indices = np.unique(np.asarray(indices, dtype=np.int64))
+        indices = indices[(indices >= 0) & (indices < self.tot_frames)]
+        if len(indices) == 0:
+            return np.empty((0, self.height, self.width), dtype=self.dtype)
+        # evenly spaced indices are just a hyperslab
+        steps = np.diff(indices)
+        if len(indices) == 1 or (steps == steps[0]).all():
+            step = int(steps[0]) if len(steps) > 0 else 1
+            return self.read_strided(
+                int(indices[0]), int(indices[-1]) + 1, step)
+        return self.dataset[indices.tolist(), :, :]
+
     def __len__(self):
         return self.tot_frames
 
@@ -66,8 +149,9 @@ class readVideoHDF5:
 
 class readFullDataFromVideoHDF5(readVideoHDF5):
 
-    def __init__(self, fileName):
-        super().__init__(fileName, dataset='/full_data')
+    def __init__(self, fileName, video_info=None):
+        super().__init__(
+            fileName, dataset='/full_data', video_info=video_info)
 
     def read(self):
         self.curr_frame += 1
@@ -0,0 +1,11 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Lightweight description of a video, obtained from its metadata only
+"""
+
+from collections import namedtuple
+
+VideoInfo = namedtuple(
+    'VideoInfo',
+    ['video_file', 'first_frame', 'tot_frames', 'height', 'width', 'dtype'])
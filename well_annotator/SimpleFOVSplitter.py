@@ -9,8 +9,8 @@ Very minimal version of the FOVMultiWellsSplitter class, to decouple this
 from Tierpsy
 """
 
-import cv2
-import tables
+import os
+import threading
 import numpy as np
 import pandas as pd
 from collections import OrderedDict
@@ -22,6 +22,175 @@ WELLS_COLS = [
     'well_name', 'is_good_well'
     ]
 
+WELLS_GEOMETRY_DTYPE = np.dtype([
+    ('y_min', np.int32), ('y_max', np.int32),
+    ('x_min', np.int32), ('x_max', np.int32),
+    ])
+
+# process-wide cache of the wells info, {path: (mtime_ns, wells_info)}
+_wells_info_cache = {}
+_wells_info_cache_lock = threading.Lock()
+
+
+def _read_wells_info(hdf5_filename):
+    """
+    Read wells dataframe and attributes of /fov_wells in a single open
+    """
+    with pd.HDFStore(hdf5_filename, 'r') as fid:
+        # read wells dataframe, handle error
+        try:
+            wells = fid['/fov_wells']
+        except KeyError as e:
+            msg = 'Could not find the wells information in the file!'
+            raise KeyError(msg) from e
+        attrs = fid.get_node('/fov_wells')._v_attrs
+        img_shape = tuple(int(x) for x in attrs['img_shape'])
+        is_dubious = 'is_dubious' in attrs and bool(attrs['is_dubious'])
+
+    # only columns we know about
+    assert all(col in WELLS_COLS for col in wells), (
+        'Unknown column in /fov_wells')
+
+    # freeze the geometry
+    geometry = np.empty(len(wells), dtype=WELLS_GEOMETRY_DTYPE)
+    for col in WELLS_GEOMETRY_DTYPE.names:
+        geometry[col] = wells[col].to_numpy()
+    geometry.flags.writeable = False
+    well_names = tuple(wells['well_name'])
+
+    return wells, well_names, geometry, img_shape, is_dubious
+
+
+def get_wells_info(hdf5_filename):
+    """
+    Cached version of _read_wells_info, the file is read again only if it
+    was modified. Do not modify the returned dataframe in place.
+    """
+    path = os.path.abspath(hdf5_filename)
+    mtime = os.stat(path).st_mtime_ns
+    with _wells_info_cache_lock:
+        cached = _wells_info_cache.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    wells_info = _read_wells_info(path)
+    with _wells_info_cache_lock:
+        _wells_info_cache[path] = (mtime, wells_info)
+    return wells_info
+
+
+def tile_FOV(img, well_names, geometry):
+    """
+    Function that tiles the input image or stack and
+    returns a dictionary of (well_name, well_stack).
+    Wells fully inside the image are views of img, only wells crossing
+    the image border are copied and padded (replicating the edge pixels).
+    Does not modify its inputs.
+    """
+    assert img.ndim in [2, 3], 'Can only tile 2D or 3D arrays'
+    height, width = img.shape[-2:]
+
+    # clip to the image, keeping at least one pixel
+    y_0 = np.clip(geometry['y_min'], 0, height - 1)
+    y_1 = np.maximum(np.minimum(geometry['y_max'], height), y_0 + 1)
+    x_0 = np.clip(geometry['x_min'], 0, width - 1)
+    x_1 = np.maximum(np.minimum(geometry['x_max'], width), x_0 + 1)
+    pads = np.maximum(np.stack([
+        y_0 - geometry['y_min'], geometry['y_max'] - y_1,
+        x_0 - geometry['x_min'], geometry['x_max'] - x_1,
+        ], axis=1), 0).tolist()
+    y_0, y_1, x_0, x_1 = y_0.tolist(), y_1.tolist(), x_0.tolist(), x_1.tolist()
+
+    # initialise output
+    out_dict = OrderedDict()
+    for wc, well_name in enumerate(well_names):
+        well_img = img[..., y_0[wc]:y_1[wc], x_0[wc]:x_1[wc]]
+        top, bottom, left, right = pads[wc]
+        if top or bottom or left or right:
+            # single copy, only for the wells at the edge
+            pad_width = [(0, 0)] * (img.ndim - 2)
+            pad_width += [(top, bottom), (left, right)]
+            well_img = np.pad(well_img, pad_width, mode='edge')
+        out_dict[well_name] = well_img
+
+    return out_dict
+
+
+def tile_FOV_tensor(img, geometry, tile_size=None):
+    """
+    Alternative to tile_FOV that returns a single contiguous array of
+    shape (n_wells, n_frames, tile_height, tile_width), made with one
+    gather from the input image or stack (2D input gives n_frames = 1).
+    Without tile_size, all tiles have the size of the largest well and
+    start at the well's (y_min, x_min). With tile_size, tiles are
+    tile_size x tile_size squares centred on each well.
+    Pixels past a well's edge replicate the well's own edge, and pixels
+    outside of the image replicate the image's edge, so no pixel from a
+    neighbouring well ends up in a tile.
+    """
+    assert img.ndim in [2, 3], 'Can only tile 2D or 3D arrays'
+    if img.ndim == 2:
+        img = img[None, ...]
+    n_frames, height, width = img.shape
+
+    wells_height = geometry['y_max'] - geometry['y_min']
+    wells_width = geometry['x_max'] - geometry['x_min']
+    if tile_size is None:
+        tile_height = int(wells_height.max())
+        tile_width = int(wells_width.max())
+        y_start = geometry['y_min']
+        x_start = geometry['x_min']
+    else:
+        tile_height = tile_width = tile_size
+        # crop bigger wells around their centre,
+        # pad smaller ones evenly (extra pixel at the bottom/right)
+        y_start = geometry['y_min'] + np.where(
+            wells_height >= tile_size,
+            (wells_height - tile_size) // 2,
+            -((tile_size - wells_height) // 2))
+        x_start = geometry['x_min'] + np.where(
+            wells_width >= tile_size,
+            (wells_width - tile_size) // 2,
+            -((tile_size - wells_width) // 2))
+
+    # clipping the coordinates is the same as replicating the edges
+    rows = np.clip(
+        y_start[:, None] + np.arange(tile_height)[None, :],
+        geometry['y_min'][:, None], geometry['y_max'][:, None] - 1)
+    rows = np.clip(rows, 0, height - 1)
+    cols = np.clip(
+        x_start[:, None] + np.arange(tile_width)[None, :],
+        geometry['x_min'][:, None], geometry['x_max'][:, None] - 1)
+    cols = np.clip(cols, 0, width - 1)
+    tensor = img[
+        np.arange(n_frames)[None, :, None, None],
+        rows[:, None, :, None],
+        cols[:, None, None, :]
+        ]
+    return tensor
+
+
+def stack_wells_tensor(well_stacks, tile_size):
+    """
+    Same as tile_FOV_tensor(..., tile_size=tile_size), for wells that were
+    already cut out of the FOV (e.g. the values of tile_FOV's output).
+    Each well is cropped or padded around its centre straight into one
+    (n_wells, n_frames, tile_size, tile_size) array.
+    All wells must have the same number of frames.
+    """
+    well_stacks = list(well_stacks)
+    if len(well_stacks) == 0:
+        return np.empty((0, 0, tile_size, tile_size), dtype=np.uint8)
+    first_stack = well_stacks[0]
+    n_frames = first_stack.shape[0] if first_stack.ndim == 3 else 1
+    tensor = np.empty(
+        (len(well_stacks), n_frames, tile_size, tile_size),
+        dtype=first_stack.dtype)
+    geometry = np.zeros(1, dtype=WELLS_GEOMETRY_DTYPE)
+    for wc, well_stack in enumerate(well_stacks):
+        geometry['y_max'], geometry['x_max'] = well_stack.shape[-2:]
+        tensor[wc] = tile_FOV_tensor(well_stack, geometry, tile_size)[0]
+    return tensor
+
 
 class SimpleFOVSplitter(object):
     """
@@ -32,27 +201,22 @@ class SimpleFOVSplitter(object):
 
     def __init__(self, hdf5_filename):
 
-        # read wells dataframe, handle error
-        try:
-            self.wells = pd.read_hdf(hdf5_filename, '/fov_wells')
-        except KeyError as e:
-            msg = 'Could not find the wells information in the file!'
-            raise KeyError(msg) from e
+        (wells, self.well_names, self.geometry, self.img_shape,
+         is_dubious) = get_wells_info(hdf5_filename)
+        # copy, as the cached dataframe is shared
+        self.wells = wells.copy()
+        if is_dubious:
+            print(f'Check {hdf5_filename} for plate alignment')
 
-        # add all columns we'll need later
-        assert all(col in WELLS_COLS for col in self.wells), (
-            'Unknown column in /fov_wells')
-        # self.wells = self.wells.reindex(columns=WELLS_COLS)
-        # self.wells['x'] = 0.5 * (self.wells['x_min'] + self.wells['x_max'])
-        # self.wells['y'] = 0.5 * (self.wells['y_min'] + self.wells['y_max'])
-        # self.wells['r'] = self.wells['x_max'] - self.wells['x']
-
-        # read extra useful info
-        with tables.File(hdf5_filename, 'r') as fid:
-            self.img_shape = fid.get_node('/fov_wells')._v_attrs['img_shape']
-            if 'is_dubious' in fid.get_node('/fov_wells')._v_attrs:
-                if fid.get_node('/fov_wells')._v_attrs['is_dubious']:
-                    print(f'Check {hdf5_filename} for plate alignment')
+    def get_well_bounds(self):
+        """
+        Return an OrderedDict of (well_name, (y_min, y_max, x_min, x_max)).
+        Bounds are in image coordinates, and can extend beyond the image.
+        """
+        return OrderedDict(
+            (well_name, tuple(int(x) for x in bounds))
+            for well_name, bounds in zip(
+                self.well_names, self.geometry.tolist()))
 
     # def tile_FOV(self, img):
     #     """
@@ -75,51 +239,4 @@ class SimpleFOVSplitter(object):
         Function that tiles the input image or stack and
         returns a dictionary of (well_name, well_stack).
         """
-        assert img.ndim in [2, 3], 'Can only tile 2D or 3D arrays'
-        if img.ndim == 2:
-            was_2D = True
-            img = img[None, ...]
-        else:
-            was_2D = False
-
-        # check if we need padding
-        if self.wells['x_max'].max() > img.shape[2]:
-            right_pad = self.wells['x_max'].max() - img.shape[2]
-            args = [0, 0, 0, right_pad, cv2.BORDER_REPLICATE]
-            img = np.concatenate(
-                [cv2.copyMakeBorder(_im, *args)[None, ...] for _im in img])
-
-        if self.wells['y_max'].max() > img.shape[1]:
-            bottom_pad = self.wells['y_max'].max() - img.shape[1]
-            args = [0, bottom_pad, 0, 0, cv2.BORDER_REPLICATE]
-            img = np.concatenate(
-                [cv2.copyMakeBorder(_im, *args)[None, ...] for _im in img])
-
-        if self.wells['x_min'].min() < 0:
-            left_pad = - self.wells['x_min'].min()
-            args = [0, 0, left_pad, 0, cv2.BORDER_REPLICATE]
-            img = np.concatenate(
-                [cv2.copyMakeBorder(_im, *args)[None, ...] for _im in img])
-            self.wells['x_min'] = self.wells['x_min'] + left_pad
-
-        if self.wells['y_min'].min() < 0:
-            top_pad = - self.wells['y_min'].min()
-            args = [top_pad, 0, 0, 0, cv2.BORDER_REPLICATE]
-            img = np.concatenate(
-                [cv2.copyMakeBorder(_im, *args)[None, ...] for _im in img])
-            self.wells['y_min'] = self.wells['y_min'] + top_pad
-
-        if was_2D:
-            img = img[0]
-
-        # initialise output
-        out_dict = OrderedDict()
-        for _, well in self.wells.iterrows():
-            out_dict[well['well_name']] = img[
-                ...,
-                well['y_min']:well['y_max'],
-                well['x_min']:well['x_max']
-                ]
-
-        return out_dict
-
+        return tile_FOV(img, self.well_names, self.geometry)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Load and tile videos in background threads ahead of time, so that moving
+to the next video does not block the GUI.
+
+@author: lferiani
+"""
+
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+
+
+def _tiles_nbytes(loaded):
+    tiles = loaded['tiles']
+    if hasattr(tiles, 'nbytes'):
+        return tiles.nbytes
+    return sum(stack.nbytes for stack in tiles.values())
+
+
+class TilesPrefetcher(object):
+    """
+    Run load_fun(key) in a pool of worker threads for the keys we expect to
+    need next, and keep the results in an in-memory LRU cache that fits in
+    max_memory_mb.
+    load_fun must return a dict with (at least) a 'tiles' entry, the
+    OrderedDict of (well_name, well_stack).
+    """
+
+    def __init__(self, load_fun, max_workers=1, max_memory_mb=2048):
+        self.load_fun = load_fun
+        self.max_memory_bytes = int(max_memory_mb * 2**20)
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='tiles_prefetch')
+        self._lock = threading.RLock()
+        self._futures = {}  # key: future, for loads in progress
+        self._loaded = OrderedDict()  # key: loaded, oldest first
+        self._loaded_bytes = 0
+
+    def _store(self, key, future):
+        """
+        Callback run when a load finishes: move the result to the LRU
+        and evict the least recently used entries if over budget
+        """
+        with self._lock:
+            if self._futures.get(key) is not future:
+                # cleared while loading
+                return
+            del self._futures[key]
+            if future.cancelled() or future.exception() is not None:
+                if not future.cancelled():
+                    print(f'Failed to prefetch {key}: '
+                          + f'{future.exception()!r}')
+                return
+            loaded = future.result()
+            self._loaded[key] = loaded
+            self._loaded_bytes += _tiles_nbytes(loaded)
+            while (self._loaded_bytes > self.max_memory_bytes
+                   and len(self._loaded) > 1):
+                _, evicted = self._loaded.popitem(last=False)
+                self._loaded_bytes -= _tiles_nbytes(evicted)
+
+    def _submit(self, key):
+        """
+        Start loading key unless it's already loaded or loading.
+        Return the future of the load, None if already loaded.
+        Call with self._lock held
+        """
+        if key in self._loaded:
+            return None
+        if key in self._futures:
+            return self._futures[key]
+        future = self._pool.submit(self.load_fun, key)
+        self._futures[key] = future
+        # if the load is already done this runs now, and removes the future
+        # from self._futures, so callers need the returned future
+        future.add_done_callback(lambda f: self._store(key, f))
+        return future
+
+    def prefetch(self, keys):
+        """
+        Start loading the keys in the background, in order
+        """
+        with self._lock:
+            for key in keys:
+                self._submit(key)
+
+    def get(self, key):
+        """
+        Return the result of load_fun(key), from the LRU if it was prefetched,
+        waiting for the worker if it's still loading, or loading it in a
+        worker now if it was never asked for.
+        The prefetches that have not started yet are cancelled, so key does
+        not wait behind them.
+        """
+        with self._lock:
+            if key in self._loaded:
+                self._loaded.move_to_end(key)
+                return self._loaded[key]
+            # cancelling runs the callback, which edits _futures
+            for other_key, other_future in list(self._futures.items()):
+                if other_key != key:
+                    other_future.cancel()
+            future = self._submit(key)
+        # the callback may not have run yet, so use the future's result
+        return future.result()
+
+    def is_ready(self, key):
+        with self._lock:
+            return key in self._loaded
+
+    def clear(self, wait=False):
+        """
+        Forget everything loaded, cancel the loads that have not started.
+        If wait, also wait for the loads already running to finish
+        (their results are discarded)
+        """
+        with self._lock:
+            # cancelling runs the callback, which would edit _futures
+            futures, self._futures = self._futures, {}
+            for future in futures.values():
+                future.cancel()
+            self._loaded.clear()
+            self._loaded_bytes = 0
+        if wait:
+            wait_futures(futures.values())
+
+    def shutdown(self):
+        self.clear()
+        self._pool.shutdown(wait=False)
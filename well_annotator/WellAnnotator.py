@@ -10,7 +10,7 @@ Created on Wed Jul 15 16:12:37 2020
 # and allow to move within the plates
 
 import sys
-import h5py
+import time
 import numpy as np
 import pandas as pd
 import warnings
@@ -38,13 +38,20 @@ from well_annotator.helper import (
     check_good_input,
     get_or_create_annotations_file,
     get_list_masked_or_feats,
-    WELLS_ANNOTATIONS_DF_COLS,
     BUTTON_STYLESHEET_STR,
     BTN_COLOURS,
     WELL_LABELS,
+    HDF5_LOCK,
+    CNN_CROP_SIZE,
+    CNN_BATCH_IMAGES,
     )
 from well_annotator.HDF5VideoPlayer import LineEditDragDrop
+from well_annotator.AnnotationStore import AnnotationStore
+from well_annotator.AnnotationBackends import get_annotation_backend
+from well_annotator.Autosaver import (
+    Autosaver, get_autosave_path, read_snapshot)
 from well_annotator.WellsVideoPlayer import WellsVideoPlayerGUI
+from well_annotator.SimpleFOVSplitter import stack_wells_tensor
 
 
 def _updateUI(ui):
@@ -134,6 +141,9 @@ def _updateUI(ui):
     ui.save_b = QPushButton(ui.centralWidget)
     ui.save_b.setText("Save")
     ui.save_b.setToolTip("Shortcut: s")
+    ui.autosave_label = QLabel(ui.centralWidget)
+    ui.autosave_label.setObjectName("autosave_label")
+    ui.autosave_label.setText("")
 
     # update field with filename, placeholder text and tooltip
     ui.lineEdit_video.setPlaceholderText(
@@ -189,6 +199,7 @@ def _updateUI(ui):
     # cluster: export/save
     ui.gridLayout_R5.addWidget(ui.export_csv_b, 0, 0)
     ui.gridLayout_R5.addWidget(ui.save_b, 0, 1)
+    ui.gridLayout_R5.addWidget(ui.autosave_label, 1, 0, 1, 2)
 
     return ui
 
@@ -203,10 +214,25 @@ class WellsAnnotator(WellsVideoPlayerGUI):
         # properties
         self.wellsanns_file = None
         self.filenames_df = None
+        # indexes of filenames_df: {file_id: filename}, sorted file_ids
+        self._filenames = {}
+        self._sorted_file_ids = np.array([], dtype=np.int64)
         self.working_dir = None
-        self.wells_annotations_df = None
+        self.annotations = None  # AnnotationStore
+        # reads/writes self.wellsanns_file, hdf5 or sqlite
+        self.backend = None
+        self._is_filenames_df_changed = False
+        # snapshot the labels in the background after a few edits,
+        # or a few seconds after the last one
+        self.autosaver = Autosaver(
+            lambda: self.annotations.snapshot(),
+            interval_ms=5000,
+            n_edits=20,
+            parent=self)
         self.current_file_id = None
         self._nn_voting_mode = None
+        # how many of the videos we could open next to load in the background
+        self.n_prefetch_videos = 2
 
         self.buttons = {
             1: self.ui.good_well_b,
@@ -235,6 +261,7 @@ class WellsAnnotator(WellsVideoPlayerGUI):
         self.ui.run_nn_b.clicked.connect(self.run_wellclassifier_fun)
         self.ui.rescan_dir_b.clicked.connect(self.rescan_working_dir)
         self.ui.export_csv_b.clicked.connect(self.export_csv_fun)
+        self.autosaver.status_changed.connect(self.ui.autosave_label.setText)
         for btn in self.ui.nn_mode_rbg.buttons():
             btn.toggled.connect(self.on_nn_mode_toggled)
         # self.ui.checkBox_prestim_only.clicked.connect(self.print_checkBox)
@@ -245,9 +272,45 @@ class WellsAnnotator(WellsVideoPlayerGUI):
     @WellsVideoPlayerGUI.target_frames_to_read.setter
     def target_frames_to_read(self, value):
         self._target_frames_to_read = value
+        self.prefetcher.clear()
         if self.current_file_id is not None:
             self.updateVideoFile(self.current_file_id)
 
+    @property
+    def wells_annotations_df(self):
+        """
+        All the annotations as a DataFrame. Exported from the store on
+        demand, so do not modify it expecting the annotations to change.
+        Reads from disk the annotations of the files not opened yet
+        """
+        if self.annotations is None:
+            return None
+        self._load_all_annotations()
+        return self.annotations.to_dataframe()
+
+    def _load_all_annotations(self):
+        """
+        Only the files being worked on are read when opening a project,
+        read all the others
+        """
+        saved_df = self.backend.read_unloaded()
+        if saved_df is not None:
+            self.annotations.merge_saved(saved_df)
+
+    def _update_file_indexes(self, new_filenames_df, is_reset=False):
+        """
+        Add the files in new_filenames_df to the file_id indexes,
+        or rebuild the indexes from scratch
+        """
+        if is_reset:
+            self._filenames = {}
+        self._filenames.update(
+            zip(new_filenames_df['file_id'].to_list(),
+                new_filenames_df['filename'].to_list()))
+        self._sorted_file_ids = np.sort(
+            np.fromiter(self._filenames.keys(), dtype=np.int64,
+                        count=len(self._filenames)))
+
     def print_checkBox(self):
         "dummy debugging function"
         print(self.ui.checkBox_prestim_only.isChecked())
@@ -256,7 +319,8 @@ class WellsAnnotator(WellsVideoPlayerGUI):
         print('choosing annotations file')
         annfilename, _ = QFileDialog.getOpenFileName(
             self, "Find HDF5 annotations file", str(self.working_dir),
-            "HDF5 files (*wells_annotations.hdf5);; All files (*)")
+            "HDF5 files (*wells_annotations.hdf5);; "
+            "Databases (*wells_annotations.sqlite);; All files (*)")
         print(f'chosen file: {annfilename}')
         if self.check_good_input(annfilename):
             self.updateAnnotationsFile(annfilename)
@@ -274,8 +338,9 @@ class WellsAnnotator(WellsVideoPlayerGUI):
         is_prestim_only = self.ui.checkBox_prestim_only.isChecked()
         # get path to annotation file on disk
         try:
-            self.wellsanns_file = get_or_create_annotations_file(
-                input_path, is_prestim_only=is_prestim_only)
+            with HDF5_LOCK:
+                self.wellsanns_file = get_or_create_annotations_file(
+                    input_path, is_prestim_only=is_prestim_only)
         except Exception as ee:
             err_msg = f"Error:\n{ee.args[0]}"
             QMessageBox.critical(
@@ -286,17 +351,22 @@ class WellsAnnotator(WellsVideoPlayerGUI):
             self.wellsanns_file = None
             return
 
+        # stop autosaving the previous file
+        self.autosaver.set_path(None)
+        self.ui.autosave_label.setText("")
+
         # read its content
-        with pd.HDFStore(self.wellsanns_file) as fid:
-            self.filenames_df = fid['/filenames_df'].copy()
-            self.working_dir = Path(
-                fid.get_storer('filenames_df').attrs.working_dir)
-            self.wells_annotations_df = fid['/wells_annotations_df'].copy()
-            try:
-                _nn_voting_mode = fid.get_storer(
-                    'wells_annotations_df').attrs['nn_voting_mode']
-            except KeyError:
-                _nn_voting_mode = 'mode'
+        if self.backend is not None:
+            self.backend.close()
+        self.backend = get_annotation_backend(self.wellsanns_file)
+        (self.filenames_df, self.working_dir,
+         self.annotations, _nn_voting_mode) = self.backend.load()
+        self._update_file_indexes(self.filenames_df, is_reset=True)
+        self.annotations.register_files(self._sorted_file_ids)
+        self._is_filenames_df_changed = False
+        self._recover_autosave()
+        self.autosaver.set_path(get_autosave_path(
+            self.wellsanns_file, annotator=self.backend.annotator))
 
         self.ui.lineEdit_video.setText(str(self.wellsanns_file))
 
@@ -323,11 +393,88 @@ class WellsAnnotator(WellsVideoPlayerGUI):
 
         return
 
-    def updateVideoFile(self, file_id_to_open):
+    def _recover_autosave(self):
+        """
+        The autosaved file is deleted when saving, so if there is one the
+        GUI was closed (or crashed) without saving: ask whether to restore
+        the autosaved labels
+        """
+        autosave_path = get_autosave_path(
+            self.wellsanns_file, annotator=self.backend.annotator)
+        if not autosave_path.exists():
+            return
+        try:
+            snapshot = read_snapshot(autosave_path)
+            autosaved_df = AnnotationStore.snapshot_to_dataframe(snapshot)
+            autosaved_df = autosaved_df[snapshot['is_labelled']]
+        except Exception as e:
+            print(f'Could not read {autosave_path}: {e!r}')
+            return
+        # count the wells we labelled whose label differs from what's on
+        # disk. Only read the files in the snapshot
+        cmp_cols = ['file_id', 'well_name', 'well_label']
+        saved_dfs = [pd.DataFrame(columns=cmp_cols)]
+        for file_id in autosaved_df['file_id'].unique().tolist():
+            saved_df = self.backend.read_file(file_id)
+            if saved_df is not None:
+                self.annotations.merge_saved(saved_df)
+            if self.annotations.has_file(file_id):
+                saved_df = self.annotations.get_file(file_id).reset_index()
+                saved_dfs.append(saved_df[cmp_cols])
+        cmp_df = autosaved_df.merge(
+            pd.concat(saved_dfs, ignore_index=True),
+            on=['file_id', 'well_name'],
+            how='left',
+            suffixes=('', '_saved'))
+        n_changed = (cmp_df['well_label'] != cmp_df['well_label_saved']).sum()
+        if n_changed == 0:
+            autosave_path.unlink()
+            return
+        autosave_time = time.strftime(
+            '%Y-%m-%d %H:%M:%S',
+            time.localtime(autosave_path.stat().st_mtime))
+        reply = QMessageBox.question(
+            self,
+            'Recover autosave',
+            f'{n_changed} wells were labelled after the last save, '
+            f'and autosaved at {autosave_time}.\n'
+            'Do you want to recover these labels?',
+            QMessageBox.No | QMessageBox.Yes,
+            QMessageBox.Yes)
+        if reply == QMessageBox.Yes:
+            # will be written to the annotations file at the next save
+            self.annotations.apply_snapshot(snapshot)
+        else:
+            autosave_path.unlink()
+        return
+
+    def updateVideoFile(self, file_id_to_open, interactive=True):
+        """
+        Open the video file_id_to_open and its wells' labels.
+        If interactive is False (e.g. when classifying all the videos),
+        only print warnings instead of waiting for the user to close them
+        """
         # print(f'file_id before updating: {self.current_file_id})')
-        # store the previous video's annotations in self.wells_annotations_df
+        # store the previous video's annotations in self.annotations
         if self.wells_df is not None:
             self.store_progress()
+            if self.current_file_id != file_id_to_open:
+                self.backend.release_file(self.current_file_id)
+        # let other annotators know we're working on this file
+        claimed_by = self.backend.claim_file(file_id_to_open)
+        if claimed_by is not None:
+            warn_msg = (
+                f'{claimed_by} is annotating this video at the moment.\n'
+                'Your labels could overwrite theirs.')
+            if interactive:
+                QMessageBox.warning(
+                    self, 'Video in use', warn_msg, QMessageBox.Ok)
+            else:
+                print(f'file_id {file_id_to_open}: {warn_msg}')
+        # get what others have saved since we loaded the annotations
+        saved_df = self.backend.read_file(file_id_to_open)
+        if saved_df is not None:
+            self.annotations.merge_saved(saved_df)
         # get the name of the next video to open
         vfile_to_open = self.get_vfilename_from_file_id(file_id_to_open)
         # use WellsVideoPlayer's
@@ -335,18 +482,41 @@ class WellsAnnotator(WellsVideoPlayerGUI):
         self.current_file_id = file_id_to_open
         # but then overwrite the self.wells_df in case this file had already
         # been annotated to a certain extent
-        if self.current_file_id in self.wells_annotations_df['file_id'].values:
-            self.wells_df = self.wells_annotations_df.query(
-                f'file_id == {self.current_file_id}').set_index('well_name')
+        if self.annotations.has_file(self.current_file_id):
+            self.wells_df = self.annotations.get_file(self.current_file_id)
         else:
-            # add labels column
+            # add labels column, and the wells to the store
             self.wells_df['well_label'] = 0
             self.wells_df['file_id'] = self.current_file_id
+            self.annotations.add_file(self.current_file_id, self.wells_df)
         # update ui elements
         self.ui.label_vid_counter.setText(
             (f'{self.current_file_id+1}/'
-             + f'{len(self.filenames_df)}'))
+             + f'{len(self._filenames)}'))
         self._refresh_buttons()
+        self.prefetch_next_videos()
+        return
+
+    def prefetch_next_videos(self):
+        """
+        Start loading in the background the videos we're likely to open next:
+        the next one with unannotated wells, then the following ones
+        """
+        candidate_ids = [
+            self._find_next_file_with_unannotated_wells(self.current_file_id)]
+        candidate_ids += [
+            self.current_file_id + cc
+            for cc in range(1, self.n_prefetch_videos + 1)]
+        fnames_to_prefetch = []
+        for file_id in candidate_ids:
+            if (file_id is None) or (file_id == self.current_file_id):
+                continue
+            if file_id not in self._filenames:
+                continue
+            fname = self.get_vfilename_from_file_id(file_id)
+            if fname not in fnames_to_prefetch:
+                fnames_to_prefetch.append(fname)
+        self.prefetch_videos(fnames_to_prefetch[:self.n_prefetch_videos])
         return
 
     def get_next_file_with_unannotated_wells(self, file_id=None):
@@ -357,38 +527,31 @@ class WellsAnnotator(WellsVideoPlayerGUI):
         # print("finding next file with unannotated wells")
         if file_id is None:
             file_id = self.current_file_id
-        # print(f'must be > {file_id}')
-
-        if self.wells_annotations_df.shape[0] == 0:
-            # print('no wells annotated yet, go to beginning')
+        next_file_id = self._find_next_file_with_unannotated_wells(file_id)
+        if next_file_id is None:
+            # there are no files with unannotated wells
+            QMessageBox.information(
+                self, 'Finished', 'All wells have been annotated.',
+                QMessageBox.Ok)
             return 0
-        # is this the very last video in the list? if yes, restart
-        if file_id == self.filenames_df['file_id'].max():
-            # print('already at end of files list, restart from beginning')
-            return self.get_first_file_to_process()
-        # is this the max file_id in wells_annotations_df?
-        # if yes, we just open a new one
-        if file_id == self.wells_annotations_df['file_id'].max():
-            # we should now be able to go to the next video
-            # because I've already checked this is not the last one
-            return file_id + 1
-        # are there files with wells that have not been annotated yet?
-        left_behind = self.get_file_id_with_skipped_wells()
-        if len(left_behind) > 0:
-            left_behind = np.array(left_behind)
-            if any(lb > file_id for lb in left_behind):
-                # print(f'found {left_behind}')
-                next_file_id = left_behind[left_behind > file_id].min()
-            else:
-                # print('any file with non annotated wells is behind this one')
-                next_file_id = left_behind.min()
-            return next_file_id
-        # if we get here, there are no files with unannotated wells
-        # print('all wells annotated')
-        QMessageBox.information(
-            self, 'Finished', 'All wells have been annotated.',
-            QMessageBox.Ok)
-        return 0
+        return next_file_id
+
+    def _find_next_file_with_unannotated_wells(self, file_id):
+        """
+        same as get_next_file_with_unannotated_wells, but return None instead
+        of warning the user if all wells have been annotated
+        """
+        # files with unlabelled wells, or not opened yet, are kept sorted
+        # in the store, restart from the beginning if none is after file_id
+        next_file_id = self.annotations.next_pending_file(file_id)
+        # skip files other annotators are working on
+        claimed_file_ids = self.backend.claimed_by_others()
+        first_file_id = next_file_id
+        while next_file_id in claimed_file_ids:
+            next_file_id = self.annotations.next_pending_file(next_file_id)
+            if next_file_id == first_file_id:
+                return None
+        return next_file_id
 
     def get_first_file_to_process(self):
         return self.get_next_file_with_unannotated_wells(file_id=-1)
@@ -396,18 +559,11 @@ class WellsAnnotator(WellsVideoPlayerGUI):
     def get_file_id_with_skipped_wells(self):
         # left behind is list of file ids that have well labels 0
         # or have not been seen yet
-        left_behind = self.wells_annotations_df.query(
-            'well_label == 0')['file_id'].unique().tolist()
-        left_behind = left_behind + list(
-            set(self.filenames_df['file_id'].to_list()) -
-            set(self.wells_annotations_df['file_id'].to_list())
-            )
-        return left_behind
+        return self.annotations.pending_file_ids()
 
     def get_vfilename_from_file_id(self, file_id_to_open):
         try:
-            fname = self.filenames_df.set_index(
-                'file_id').loc[file_id_to_open, 'filename']
+            fname = self._filenames[file_id_to_open]
         except Exception as EE:
             print(f'Failed to find filename of file_id {file_id_to_open}')
             print('This is how self.filenames_df look like:')
@@ -439,14 +595,14 @@ class WellsAnnotator(WellsVideoPlayerGUI):
             str(f.relative_to(self.working_dir)) for f in tierpsy_fnames]
         # remove the ones that already existed
         new_tierpsy_fnames = list(
-            set(tierpsy_fnames) - set(self.filenames_df['filename'].to_list()))
+            set(tierpsy_fnames) - set(self._filenames.values()))
         # check for early exit
         if len(new_tierpsy_fnames) == 0:
             print('No new files found')
             return
         # if new files were found
         n_new_files = len(new_tierpsy_fnames)
-        prev_max_id = self.filenames_df['file_id'].max()
+        prev_max_id = self._sorted_file_ids[-1]
         prev_max_index = self.filenames_df.index.max()
         new_file_ids = [prev_max_id + 1 + cc for cc in range(n_new_files)]
         new_index = [prev_max_index + 1 + cc for cc in range(n_new_files)]
@@ -457,6 +613,9 @@ class WellsAnnotator(WellsVideoPlayerGUI):
         print(f'{n_new_files} new files found')
         self.filenames_df = pd.concat(
             [self.filenames_df, new_filenames_df], axis=0)
+        self._update_file_indexes(new_filenames_df)
+        self.annotations.register_files(new_file_ids)
+        self._is_filenames_df_changed = True
 
         self.updateVideoFile(self.current_file_id)
 
@@ -464,33 +623,24 @@ class WellsAnnotator(WellsVideoPlayerGUI):
 
     def store_progress(self):
         """
-        add wells_df to self.wells_annotations_df
+        copy the labels in wells_df to self.annotations
         """
         # easy case: this is the first time we see these wells
-        if (self.current_file_id
-                not in self.wells_annotations_df['file_id'].values):
-            # print('appending')
-            self.wells_annotations_df = self.wells_annotations_df.append(
-                self.wells_df.reset_index(
-                    drop=False
-                    )[WELLS_ANNOTATIONS_DF_COLS],
-                ignore_index=True,
-                verify_integrity=True,
-                sort=True
-                )
+        if not self.annotations.has_file(self.current_file_id):
+            self.annotations.add_file(self.current_file_id, self.wells_df)
         else:
             # these wells were seen before. update them
-            idx = self.wells_annotations_df['file_id'] == self.current_file_id
-            # next line assumes wells order not to have changed
-            # since wells_df was first appendsed. sounds reasonable enough
-            assert all(
-                (self.wells_annotations_df.loc[idx, 'well_name'].values
-                 == self.wells_df.reset_index()['well_name'].values)
-                ), 'wells order not matching'
-            self.wells_annotations_df.loc[idx, 'well_label'] = (
-                self.wells_df['well_label'].values)
+            self.annotations.update_file(self.current_file_id, self.wells_df)
         return
 
+    def _set_well_label(self, well_name, label_id):
+        """
+        Label a well of the current video, both in wells_df and the store
+        """
+        self.wells_df.loc[well_name, 'well_label'] = label_id
+        self.annotations.set_label(self.current_file_id, well_name, label_id)
+        self.autosaver.notify_edit()
+
     # decorator to only run function if an annotation file has been loaded
     def _annotations_loaded_only(func):
         def wrapper(self):
@@ -612,14 +762,14 @@ class WellsAnnotator(WellsVideoPlayerGUI):
     @_annotations_loaded_only
     def next_video_fun(self):
         next_id = self.current_file_id + 1
-        if next_id in self.filenames_df['file_id'].values:
+        if next_id in self._filenames:
             self.updateVideoFile(next_id)
         return
 
     @_annotations_loaded_only
     def prev_video_fun(self):
         prev_id = self.current_file_id - 1
-        if prev_id in self.filenames_df['file_id'].values:
+        if prev_id in self._filenames:
             self.updateVideoFile(prev_id)
         return
 
@@ -683,12 +833,13 @@ class WellsAnnotator(WellsVideoPlayerGUI):
                 # find well index
                 if checked:
                     # add label
-                    self.wells_df.loc[self.well_name, 'well_label'] = label_id
+                    self._set_well_label(self.well_name, label_id)
                 else:
                     old_lab = self.wells_df.loc[self.well_name, 'well_label']
                     if old_lab == label_id:
                         # if the labeld was unchecked remove the label
-                        self.wells_df.loc[self.well_name, 'well_label'] = 0
+                        self._set_well_label(self.well_name, 0)
+                self.refresh_plate_overlay()
         # connect ui elements to callback function
         for btn_id, btn in self.buttons.items():
             btn.setCheckable(True)
@@ -696,6 +847,36 @@ class WellsAnnotator(WellsVideoPlayerGUI):
             btn.toggled.connect(partial(_make_label, btn_id))
         return
 
+    def _plate_wells_colours(self):
+        """
+        In the plate overview, outline the annotated wells with the colour
+        of their label, and the current well in white
+        """
+        colours = {}
+        if self.wells_df is not None:
+            labels = self.wells_df['well_label']
+            colours.update(
+                (well_name, BTN_COLOURS[label_id])
+                for well_name, label_id in labels[labels > 0].items())
+        colours.update(super()._plate_wells_colours())
+        return colours
+
+    def on_plate_tile_clicked(self, well_name, modifiers):
+        """
+        Ctrl+click marks a well as good (or unmarks it) without leaving
+        the plate overview, a normal click opens the well
+        """
+        if not modifiers & Qt.ControlModifier:
+            super().on_plate_tile_clicked(well_name, modifiers)
+            return
+        if self.wells_df.loc[well_name, 'well_label'] == 1:
+            self._set_well_label(well_name, 0)
+        else:
+            self._set_well_label(well_name, 1)
+        if well_name == self.well_name:
+            self._refresh_buttons()
+        self.refresh_plate_overlay()
+
     @_annotations_loaded_only
     def on_nn_mode_toggled(self):
         cbutton = self.sender()
@@ -726,25 +907,30 @@ class WellsAnnotator(WellsVideoPlayerGUI):
             action='ignore',
             category=pd.errors.PerformanceWarning
             )
-        self.wells_annotations_df.to_hdf(
-            self.wellsanns_file,
-            key='/wells_annotations_df',
-            index=False,
-            mode='r+')
-        self.filenames_df.to_hdf(
-            self.wellsanns_file,
-            key='/filenames_df',
-            index=False,
-            mode='r+')
-        # add working_dir
-        with h5py.File(self.wellsanns_file, 'r+') as fid:
-            fid["/filenames_df"].attrs["working_dir"] = str(self.working_dir)
-        # add nn_voting_mode
-        with h5py.File(self.wellsanns_file, 'r+') as fid:
-            fid["/wells_annotations_df"].attrs["nn_voting_mode"] = (
-                self.nn_voting_mode)
+        # only write what changed since the last save
+        if self._is_filenames_df_changed:
+            self.backend.save(
+                self.annotations,
+                self.nn_voting_mode,
+                filenames_df=self.filenames_df,
+                working_dir=self.working_dir)
+            self._is_filenames_df_changed = False
+        else:
+            self.backend.save(self.annotations, self.nn_voting_mode)
+        # everything is on disk now
+        self.autosaver.discard()
+        self.ui.autosave_label.setText(
+            f'Saved at {time.strftime("%H:%M:%S")}')
         return
 
+    @_annotations_loaded_only
+    def compact_annotations_file(self):
+        """
+        Save, and merge the journal of changes into the annotations table
+        """
+        self.save_to_disk_fun()
+        self.backend.compact(self.annotations, self.nn_voting_mode)
+
     @_annotations_loaded_only
     def export_csv_fun(self):
         self.store_progress()
@@ -802,11 +988,12 @@ class WellsAnnotator(WellsVideoPlayerGUI):
         wells predicted to be bad will be left unannotated for the user to
         review.
         """
-        from well_annotator.helper import (
-            load_CNN_models, preprocess_images_for_CNN, consensus_vote)
+        from well_annotator.helper import load_CNN_models
 
         is_skip_existing_annotations = False
-        if len(self.wells_annotations_df) > 0:
+        # the classifier will read all files anyway
+        self._load_all_annotations()
+        if (self.annotations.labels != 0).any():
             warn_msg = (
                 "Existing annotations detected.\n"
                 "Overwrite the existing annotations?"
@@ -817,9 +1004,7 @@ class WellsAnnotator(WellsVideoPlayerGUI):
 
             if reply_1 == QMessageBox.No:
 
-                if self.wells_annotations_df['well_label'].eq(0).any() or (
-                        self.wells_annotations_df['file_id'].max() <
-                        self.filenames_df['file_id'].max()):
+                if len(self.annotations.pending_file_ids()) > 0:
 
                     warn_msg = (
                         "Would you like to classify the unannotated wells?")
@@ -840,46 +1025,79 @@ class WellsAnnotator(WellsVideoPlayerGUI):
         # load the model
         models = load_CNN_models()
 
-        # let's make sure we're at the very beginning
-        self.updateVideoFile(0)
-        # loop through all the wells using self.next_well_fun()
-        # as it allows to move through videos as well
-        # The end of the loop is detected as file id and well name dont change
-        pbar = tqdm(desc='files processed', total=len(self.filenames_df))
-        last_file_well = (None, None)
-        while last_file_well != (self.current_file_id, self.well_name):
-            # update progress bar and store progress whenever we change file id
-            if self.current_file_id != last_file_well[0]:
-                pbar.update(n=1)
-                self.save_to_disk_fun()
+        # classify all the wells of a video in batches, without going
+        # through the wells one by one in the GUI
+        # leave alone the videos other annotators are working on
+        claimed_file_ids = self.backend.claimed_by_others()
+        for file_id in tqdm(
+                self._sorted_file_ids.tolist(), desc='files processed'):
+            if file_id in claimed_file_ids:
+                print(f'file_id {file_id} is being annotated by someone '
+                      'else, skipping it')
+                continue
+            self.updateVideoFile(file_id, interactive=False)
 
             # skip the classification if we asked not to overwrite
-            if is_skip_existing_annotations:
-                if self.wells_df.loc[self.well_name, 'well_label'] != 0:
-                    last_file_well = (self.current_file_id, self.well_name)
-                    self.next_well_fun()
-                    continue
-
-            # classify the well's images
-            images = preprocess_images_for_CNN(self.image_group)
-            well_prediction = consensus_vote(
-                models, images, consensus_type=self.nn_voting_mode)
+            well_names = [
+                well_name for well_name in self.well_names
+                if not (is_skip_existing_annotations
+                        and self.wells_df.loc[well_name, 'well_label'] != 0)
+                ]
+            well_predictions = self._classify_wells(models, well_names)
 
             # NN predicts 1 if it's bad well, 0 if it is good
             # translate prediction into label (good well, unannotated if bad)
-            if well_prediction == 0:
-                self.wells_df.loc[self.well_name, 'well_label'] = 1
-            else:
-                self.wells_df.loc[self.well_name, 'well_label'] = 0
-
-            # update last_file_well and move to next well
-            last_file_well = (self.current_file_id, self.well_name)
-            self.next_well_fun()
+            for well_name, well_prediction in zip(
+                    well_names, well_predictions):
+                if well_prediction == 0:
+                    self._set_well_label(well_name, 1)
+                else:
+                    self._set_well_label(well_name, 0)
 
-        self.save_to_disk_fun()
+            self._refresh_buttons()
+            self.save_to_disk_fun()
 
         return
 
+    def _classify_wells(self, models, well_names):
+        """
+        Run the CNN on the wells of the current video, a batch of wells at
+        a time. Return a list with the prediction for each well
+        """
+        from well_annotator.helper import (
+            preprocess_images_for_CNN, consensus_vote)
+
+        # about CNN_BATCH_IMAGES frames, from all wells, in each batch
+        n_wells_per_batch = max(
+            CNN_BATCH_IMAGES // max(self.target_frames_to_read, 1), 1)
+        well_predictions = []
+        for first in range(0, len(well_names), n_wells_per_batch):
+            # in lazy mode, only read from disk the centre of the well
+            # that the CNN uses. The well shown has been read already
+            if self.is_lazy_wells and hasattr(self.tiles, 'read_well'):
+                batch = [
+                    self.image_group if well_name == self.well_name
+                    else self.tiles.read_well(
+                        well_name, crop_size=CNN_CROP_SIZE)
+                    for well_name in well_names[
+                        first:first + n_wells_per_batch]
+                    ]
+            else:
+                batch = [
+                    self.tiles[well_name]
+                    for well_name in well_names[
+                        first:first + n_wells_per_batch]
+                    ]
+            # (n_wells, n_frames, CNN_CROP_SIZE, CNN_CROP_SIZE)
+            images = preprocess_images_for_CNN(
+                stack_wells_tensor(batch, CNN_CROP_SIZE))
+            well_predictions.extend(
+                consensus_vote(
+                    models, well_images, consensus_type=self.nn_voting_mode)
+                for well_images in images)
+
+        return well_predictions
+
     def closeEvent(self, event):
         quit_msg = "Do you want to save the current progress before exiting?"
         reply = QMessageBox.question(
@@ -889,8 +1107,19 @@ class WellsAnnotator(WellsVideoPlayerGUI):
             QMessageBox.No | QMessageBox.Yes,
             QMessageBox.Yes)
 
-        if reply == QMessageBox.Yes:
-            self.save_to_disk_fun()
+        if self.wellsanns_file is not None:
+            if reply == QMessageBox.Yes:
+                self.save_to_disk_fun()
+            else:
+                # keep the unsaved labels in the autosaved file,
+                # they will be offered back next time the file is opened
+                self.autosaver.flush()
+            # leave a single table on disk for other tools to read,
+            # with what was saved in any case
+            self.backend.compact(self.annotations, self.nn_voting_mode)
+        # release the videos we were working on
+        if self.backend is not None:
+            self.backend.close()
 
         super().closeEvent(event)
         return
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of the subsampled, tiled wells stacks of each video,
+so that a video that was already seen does not need to be read, subsampled
+and tiled again.
+
+@author: lferiani
+"""
+
+import os
+import io
+import json
+import hashlib
+import tempfile
+import h5py
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from collections import OrderedDict
+
+from well_annotator.helper import (
+    get_project_root, tierpsyoutdir2aux, HDF5_LOCK)
+
+CACHE_DIRNAME = 'wells_tiles_cache'
+CACHE_EXT = '.tiles.hdf5'
+
+
+def get_tiles_cache_dir(wellsdef_filename):
+    """
+    The cache lives in the AuxiliaryFiles folder of the project,
+    or next to the AuxiliaryFiles equivalent of the video if the project
+    root cannot be found
+    """
+    wellsdef_dir = Path(wellsdef_filename).parent
+    proj_root_dir = get_project_root(wellsdef_dir)
+    if proj_root_dir is not None:
+        aux_dir = proj_root_dir / 'AuxiliaryFiles'
+    else:
+        aux_dir = tierpsyoutdir2aux(wellsdef_dir)
+    return aux_dir / CACHE_DIRNAME
+
+
+class WellsTilesCache(object):
+    """
+    Store each video's tiled wells stacks in one hdf5 file, one compressed
+    dataset (and chunk) per well, plus the wells dataframe as json.
+    Safe to use outside of the main thread: HDF5_LOCK is held for one
+    well at a time, so that saving the annotations does not wait for a
+    whole entry to be read or written.
+    Entries are keyed by the video's path, size and modification time
+    (of all the chunks, for loopbio videos), the number of frames read and
+    the wells geometry.
+    When the cache grows beyond max_size_gb, the least recently used
+    entries are deleted.
+    """
+
+    def __init__(self, cache_dir, max_size_gb=5):
+        self.cache_dir = Path(cache_dir)
+        self.max_size_bytes = int(max_size_gb * 2**30)
+
+    @staticmethod
+    def make_key(vfilename, target_frames_to_read, wells_df, img_shape):
+        """
+        Hash of everything that determines the tiles of a video
+        """
+        if str(vfilename).endswith('.yaml'):
+            # loopbio: the frames are in the chunks and index files
+            # next to the metadata
+            vfiles = sorted(Path(vfilename).parent.iterdir())
+        else:
+            vfiles = [Path(vfilename)]
+        vstats = []
+        for vfile in vfiles:
+            vstat = os.stat(vfile)
+            vstats.append([vfile.name, vstat.st_size, vstat.st_mtime_ns])
+        key_str = json.dumps([
+            str(vfilename),
+            vstats,
+            int(target_frames_to_read),
+            [int(s) for s in img_shape],
+            ])
+        hasher = hashlib.sha1(key_str.encode())
+        bounds_cols = ['well_name', 'x_min', 'x_max', 'y_min', 'y_max']
+        hasher.update(
+            wells_df.reset_index()[bounds_cols].to_json().encode())
+        return hasher.hexdigest()
+
+    def _entry_path(self, key):
+        return self.cache_dir / (key + CACHE_EXT)
+
+    def get(self, key):
+        """
+        Return (tiles, wells_df) if the key is in the cache, None otherwise
+        """
+        entry_path = self._entry_path(key)
+        if not entry_path.exists():
+            return None
+        try:
+            with HDF5_LOCK:
+                fid = h5py.File(entry_path, 'r')
+            try:
+                with HDF5_LOCK:
+                    wells_df_json = fid['wells_df'].asstr()[()]
+                wells_df = pd.read_json(
+                    io.StringIO(wells_df_json), orient='table')
+                tiles = OrderedDict()
+                for well_name in wells_df['well_name']:
+                    with HDF5_LOCK:
+                        tiles[well_name] = fid['tiles'][well_name][()]
+            finally:
+                with HDF5_LOCK:
+                    fid.close()
+        except (OSError, KeyError) as e:
+            print(f'Could not read cached tiles, ignoring them: {e!r}')
+            return None
+        # mark as recently used
+        os.utime(entry_path)
+        return tiles, wells_df
+
+    def put(self, key, tiles, wells_df):
+        """
+        Write the tiles to disk, then evict old entries if needed
+        """
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        entry_path = self._entry_path(key)
+        # write to a temporary file so a half written entry is never read.
+        # Its name is unique, as other GUIs may be caching the same video
+        fd, tmp_path = tempfile.mkstemp(
+            suffix='.tmp', prefix=entry_path.name + '.', dir=self.cache_dir)
+        os.close(fd)
+        try:
+            with HDF5_LOCK:
+                fid = h5py.File(tmp_path, 'w')
+            try:
+                # a dataset rather than an attribute, that can't exceed 64kB
+                with HDF5_LOCK:
+                    fid.create_dataset(
+                        'wells_df',
+                        data=wells_df.to_json(orient='table', index=False))
+                    tiles_group = fid.create_group('tiles')
+                for well_name, well_stack in tiles.items():
+                    well_stack = np.ascontiguousarray(well_stack)
+                    with HDF5_LOCK:
+                        tiles_group.create_dataset(
+                            well_name,
+                            data=well_stack,
+                            chunks=(
+                                well_stack.shape if well_stack.size else None),
+                            compression='lzf',
+                            )
+            finally:
+                with HDF5_LOCK:
+                    fid.close()
+            os.replace(tmp_path, entry_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        """
+        Delete least recently used entries until the cache fits max_size_gb
+        """
+        entries = [
+            (ep.stat().st_mtime, ep.stat().st_size, ep)
+            for ep in self.cache_dir.glob('*' + CACHE_EXT)]
+        cache_size = sum(size for _, size, _ in entries)
+        for _, size, entry_path in sorted(entries):
+            if cache_size <= self.max_size_bytes:
+                break
+            try:
+                entry_path.unlink()
+                cache_size -= size
+            except OSError:
+                pass
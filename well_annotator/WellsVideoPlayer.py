@@ -5,21 +5,275 @@ Created on Fri Jun 26 16:13:32 2020
 
 @author: lferiani
 """
+import os
 import sys
+import numpy as np
+from contextlib import nullcontext
 # import tables
 from pathlib import Path
-from numpy import concatenate
+from collections import OrderedDict
 
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QRectF
+from PyQt5.QtGui import QColor, QPen, QPixmap
 from PyQt5.QtWidgets import (
     QApplication, QLabel, QPushButton, QComboBox, QHBoxLayout, QSpinBox,
-    QGridLayout, QSpacerItem, QSizePolicy)
+    QGridLayout, QSpacerItem, QSizePolicy, QCheckBox, QGraphicsView,
+    QGraphicsRectItem)
 
-from well_annotator.HDF5VideoPlayer import HDF5VideoPlayerGUI
+from well_annotator.HDF5VideoPlayer import HDF5VideoPlayerGUI, build_pyramid
+from well_annotator.PlateOverview import PlateAtlasBuilder
 from well_annotator.SimpleFOVSplitter import SimpleFOVSplitter
+from well_annotator.WellsTilesCache import (
+    WellsTilesCache, get_tiles_cache_dir)
+from well_annotator.TilesPrefetcher import TilesPrefetcher
+
+from well_annotator.selectVideoReader import selectVideoReader, probe_video
+from well_annotator.Readers.readLoopBio import make_decode_pool
+from well_annotator.helper import mask2feats, tierpsyfile2raw, HDF5_LOCK
+
+
+def resolve_video_files(value):
+    """
+    Find the file with the wells definition and the one with the video data
+    from a masked video or featuresN filename.
+    Returns (wellsdef_filename, vfilename, video_info), where video_info is
+    None if the video has not been probed yet.
+    """
+    if ('MaskedVideos' in value) and (not Path(value).exists()):
+        # input was a masked video, but it does not exist.
+        # new value for the wells definition file
+        value = mask2feats(value)
+
+    assert Path(value).exists(), (
+        'either the masked or featuresN video must exist')
+
+    # do I need to find a different file for the video data?
+
+    # probing only reads metadata, and is kept for the reader later
+    video_info = None
+    if 'MaskedVideos' in value:
+        vfile = value
+        try:
+            with HDF5_LOCK:
+                video_info = probe_video(vfile)
+        except OSError as ose:
+            print(repr(ose))
+            print(
+                'Masked video does not have full_data, trying raw video')
+            vfile = tierpsyfile2raw(value)
+    else:
+        vfile = tierpsyfile2raw(value)
+
+    return value, vfile, video_info
+
+
+# frames read from hdf5 videos while holding HDF5_LOCK, so that saving the
+# annotations does not wait for a whole video to be read in the background
+READ_CHUNK_FRAMES = 16
+
+MONTAGE_MODES = ['frames', 'filmstrip', 'max projection', 'median projection']
+
+
+def make_montage(well_stack, mode):
+    """
+    Summarise all frames of a well in a single image:
+    filmstrip lays the frames out in a grid (row by row), the projections
+    take the max or median of each pixel over time
+    """
+    if mode == 'max projection':
+        return well_stack.max(axis=0)
+    elif mode == 'median projection':
+        return np.median(well_stack, axis=0).astype(well_stack.dtype)
+    elif mode == 'filmstrip':
+        n_frames, height, width = well_stack.shape
+        n_cols = int(np.ceil(np.sqrt(n_frames)))
+        n_rows = -(-n_frames // n_cols)
+        grid = np.zeros(
+            (n_rows * n_cols, height, width), dtype=well_stack.dtype)
+        grid[:n_frames] = well_stack
+        grid = grid.reshape(n_rows, n_cols, height, width)
+        return grid.transpose((0, 2, 1, 3)).reshape(
+            n_rows * height, n_cols * width)
+    else:
+        raise ValueError(f'Unknown montage mode {mode}')
+
+
+def get_frames_skip(n_fulldata_frames, target_frames_to_read):
+    """
+    Step to read about target_frames_to_read out of n_fulldata_frames
+    """
+    if target_frames_to_read >= n_fulldata_frames:
+        skip = 1
+    else:
+        # pure python version of ceil
+        skip = -(-n_fulldata_frames // target_frames_to_read)
+    return skip
+
+
+class LazyWellsTiles(object):
+    """
+    Drop-in replacement for the dictionary of (well_name, well_stack)
+    returned by SimpleFOVSplitter.tile_FOV, that only reads a well's pixels
+    from the hdf5 video when that well is accessed.
+    The last max_cached_wells wells read are kept in memory.
+    """
+
+    def __init__(self, vfilename, well_bounds, target_frames_to_read,
+                 video_info=None, max_cached_wells=8):
+        with HDF5_LOCK:
+            self.vid = selectVideoReader(vfilename, video_info=video_info)
+        self.well_bounds = well_bounds
+        self.n_fulldata_frames = len(self.vid)
+        self.skip = get_frames_skip(
+            self.n_fulldata_frames, target_frames_to_read)
+        self.max_cached_wells = max_cached_wells
+        self._cache = OrderedDict()
+
+    def __getitem__(self, well_name):
+        if well_name in self._cache:
+            self._cache.move_to_end(well_name)
+            return self._cache[well_name]
+        well_stack = self.read_well(well_name)
+        self._cache[well_name] = well_stack
+        while len(self._cache) > self.max_cached_wells:
+            self._cache.popitem(last=False)
+        return well_stack
+
+    def __iter__(self):
+        return iter(self.well_bounds)
+
+    def __len__(self):
+        return len(self.well_bounds)
+
+    def keys(self):
+        return self.well_bounds.keys()
+
+    @property
+    def nbytes(self):
+        return sum(stack.nbytes for stack in self._cache.values())
+
+    def read_well(self, well_name, crop_size=None):
+        """
+        Read the frames of a well from disk, bypassing the cache.
+        If crop_size is given, only read a centred crop_size x crop_size
+        square (as long as the well is at least that big)
+        """
+        y_min, y_max, x_min, x_max = self.well_bounds[well_name]
+        if crop_size is not None:
+            if (y_max - y_min >= crop_size) and (x_max - x_min >= crop_size):
+                y_min += (y_max - y_min - crop_size) // 2
+                y_max = y_min + crop_size
+                x_min += (x_max - x_min - crop_size) // 2
+                x_max = x_min + crop_size
+        with HDF5_LOCK:
+            return self.vid.read_strided_roi(
+                0, self.n_fulldata_frames, self.skip,
+                y_min, y_max, x_min, x_max)
+
+    def release(self):
+        self._cache.clear()
+        with HDF5_LOCK:
+            self.vid.release()
+
+
+def load_lazy_tiles(
+        wellsdef_filename, vfilename, target_frames_to_read,
+        video_info=None):
+    """
+    Same as load_tiles, but returns a LazyWellsTiles that only reads
+    the wells when they are needed. Only works for hdf5 videos.
+    """
+    with HDF5_LOCK:
+        fovsplitter = SimpleFOVSplitter(wellsdef_filename)
+    tiles = LazyWellsTiles(
+        vfilename,
+        fovsplitter.get_well_bounds(),
+        target_frames_to_read,
+        video_info=video_info)
+    wells_df = fovsplitter.wells.copy()
+    return tiles, wells_df.set_index('well_name')
+
+
+def load_tiles(
+        wellsdef_filename, vfilename, target_frames_to_read,
+        video_info=None, n_decode_workers=0, decode_max_memory_mb=1024,
+        tiles_cache_max_gb=None, decode_pool=None):
+    """
+    Read about target_frames_to_read frames from the video, and split them
+    into wells. Safe to run outside of the main thread.
+    Raw videos are decoded in parallel in decode_pool if given (see
+    make_decode_pool), or in a pool of n_decode_workers started for this
+    video only.
+    Use the on-disk tiles cache unless tiles_cache_max_gb is None.
+    Returns (tiles, wells_df), tiles is an OrderedDict of
+    (well_name, well_stack) and wells_df is indexed by well_name.
+    """
+    # read wells definition
+    with HDF5_LOCK:
+        fovsplitter = SimpleFOVSplitter(wellsdef_filename)
+
+    # if this video was tiled before, just read the tiles from disk
+    if tiles_cache_max_gb is not None:
+        tiles_cache = WellsTilesCache(
+            get_tiles_cache_dir(wellsdef_filename),
+            max_size_gb=tiles_cache_max_gb)
+        cache_key = tiles_cache.make_key(
+            vfilename,
+            target_frames_to_read,
+            fovsplitter.wells,
+            fovsplitter.img_shape)
+        # the cache takes HDF5_LOCK itself, one well at a time
+        cached = tiles_cache.get(cache_key)
+        if cached is not None:
+            tiles, wells_df = cached
+            return tiles, wells_df.set_index('well_name')
+
+    # read the video data. Only hdf5 videos need the lock
+    lock = HDF5_LOCK if vfilename.endswith('hdf5') else nullcontext()
+    with lock:
+        vid = selectVideoReader(
+            vfilename,
+            n_workers=n_decode_workers,
+            max_memory_mb=decode_max_memory_mb,
+            video_info=video_info,
+            decode_pool=decode_pool)
+        n_fulldata_frames = len(vid)
+    try:
+        skip = get_frames_skip(n_fulldata_frames, target_frames_to_read)
+        frames_to_read = range(0, n_fulldata_frames, skip)
+        # hdf5 videos are read a few frames at a time so that the lock is
+        # released in between, raw videos in one go so that the reader can
+        # decode each chunk once (or in parallel)
+        if lock is HDF5_LOCK:
+            frames_per_read = READ_CHUNK_FRAMES
+        else:
+            frames_per_read = max(len(frames_to_read), 1)
+        # readers can return fewer frames than asked for if some are missing
+        chunk_stacks = []
+        for first in range(0, max(len(frames_to_read), 1), frames_per_read):
+            chunk = frames_to_read[first:first + frames_per_read]
+            with lock:
+                chunk_stacks.append(
+                    vid.read_strided(chunk.start, chunk.stop, skip))
+        # into a (n_frames, height, width) array
+        if len(chunk_stacks) == 1:
+            img_stack = chunk_stacks[0]
+        else:
+            img_stack = np.concatenate(chunk_stacks, axis=0)
+    finally:
+        with lock:
+            vid.release()
+    # chop up wells images and store
+    tiles = fovsplitter.tile_FOV(img_stack)
+    wells_df = fovsplitter.wells.copy()
 
-from well_annotator.selectVideoReader import selectVideoReader
-from well_annotator.helper import mask2feats, tierpsyfile2raw
+    if tiles_cache_max_gb is not None:
+        try:
+            tiles_cache.put(cache_key, tiles, wells_df)
+        except OSError as e:
+            print(f'Could not cache the tiles: {e!r}')
+
+    return tiles, wells_df.set_index('well_name')
 
 
 def _updateUI(ui):
@@ -70,6 +324,13 @@ def _updateUI(ui):
     ui.n_frames_to_read_label.setText("approx. frames to read:")
     ui.n_frames_to_read_spinBox = QSpinBox(ui.centralWidget)
     ui.n_frames_to_read_spinBox.setFocusPolicy(Qt.NoFocus)
+    # for parallel decoding of raw videos
+    ui.n_decode_workers_label = QLabel(ui.centralWidget)
+    ui.n_decode_workers_label.setText("decoding processes:")
+    ui.n_decode_workers_spinBox = QSpinBox(ui.centralWidget)
+    ui.n_decode_workers_spinBox.setFocusPolicy(Qt.NoFocus)
+    ui.n_decode_workers_spinBox.setToolTip(
+        "Decode raw (loopbio) videos in parallel. 0 or 1 to not")
     # for wells navigation
     ui.prev_well_b = QPushButton(ui.centralWidget)
     ui.prev_well_b.setText("Prev Well")
@@ -86,6 +347,27 @@ def _updateUI(ui):
     ui.label_well_counter = QLabel(ui.centralWidget)
     ui.label_well_counter.setObjectName("label_well_counter")
     ui.label_well_counter.setText("#/##")
+    # to see all wells at once
+    ui.plate_overview_checkBox = QCheckBox(ui.centralWidget)
+    ui.plate_overview_checkBox.setObjectName("plate_overview_checkBox")
+    ui.plate_overview_checkBox.setText("plate overview")
+    ui.plate_overview_checkBox.setToolTip(
+        "Show all wells. Click on a well to open it")
+    # to see all frames of a well at once
+    ui.montage_comboBox = QComboBox(ui.centralWidget)
+    ui.montage_comboBox.setEditable(False)
+    ui.montage_comboBox.setObjectName("montage_comboBox")
+    ui.montage_comboBox.addItems(MONTAGE_MODES)
+    ui.montage_comboBox.setToolTip(
+        "Show one frame at a time, all frames side by side, "
+        "or their projection over time")
+    # to read each well when needed, rather than the whole video
+    ui.lazy_wells_checkBox = QCheckBox(ui.centralWidget)
+    ui.lazy_wells_checkBox.setObjectName("lazy_wells_checkBox")
+    ui.lazy_wells_checkBox.setText("read wells when shown")
+    ui.lazy_wells_checkBox.setToolTip(
+        "Only read each well from the video when it is shown. "
+        "Uses less memory, but no prefetching. hdf5 videos only")
     # for video navigation
 
     # to know what video we're looking at
@@ -170,6 +452,8 @@ def _updateUI(ui):
     # ui.horizontalLayout_L1.addWidget(ui.playButton)
     ui.horizontalLayout_L1.addWidget(ui.n_frames_to_read_label)
     ui.horizontalLayout_L1.addWidget(ui.n_frames_to_read_spinBox)
+    ui.horizontalLayout_L1.addWidget(ui.n_decode_workers_label)
+    ui.horizontalLayout_L1.addWidget(ui.n_decode_workers_spinBox)
     # second layer under the video box
     ui.horizontalLayout_L2.addWidget(ui.lineEdit_video)
     ui.horizontalLayout_L2.addWidget(ui.pushButton_video)
@@ -180,6 +464,9 @@ def _updateUI(ui):
     ui.gridLayout_R2.addWidget(ui.wells_comboBox, 1, 0)
     ui.gridLayout_R2.addWidget(ui.label_well, 1, 1)
     ui.gridLayout_R2.addWidget(ui.label_well_counter, 1, 2)
+    ui.gridLayout_R2.addWidget(ui.plate_overview_checkBox, 2, 0)
+    ui.gridLayout_R2.addWidget(ui.montage_comboBox, 2, 1)
+    ui.gridLayout_R2.addWidget(ui.lazy_wells_checkBox, 3, 0)
 
     # video navigation cluster
     # ui.gridLayout_R3.addWidget(ui.dummy_comboBox, 1, 0)
@@ -203,6 +490,30 @@ class WellsVideoPlayerGUI(HDF5VideoPlayerGUI):
         self.wells_df = None  # current video's
         self._wellsdef_filename = ''
         self._vfilename = ''
+        self._video_info = None  # metadata of vfilename, if already probed
+        # opt-in parallel decoding of raw (loopbio) videos, in a pool
+        # shared by all the videos
+        self._n_decode_workers = 0
+        self._decode_pool = None
+        self.decode_max_memory_mb = 1024
+        # on-disk cache of the tiled wells, in the project's AuxiliaryFiles
+        self.use_tiles_cache = True
+        self.tiles_cache_max_gb = 5
+        # opt-in: only read each well from the (hdf5) video when shown
+        self.is_lazy_wells = False
+        # load videos in the background before they are needed
+        self.prefetcher = TilesPrefetcher(
+            self._load_video, max_workers=1, max_memory_mb=2048)
+        # all wells at once, built in the background
+        self.is_plate_overview = False
+        self.plate_thumb_size = 96
+        self.plate_atlas = None
+        self.plate_atlas_positions = None
+        self._plate_atlas_builder = None
+        self._plate_overlay_items = []
+        # show each frame, or all of them at once
+        self.montage_mode = 'frames'
+        self.montages = {}  # (well_name, mode): image, for this video
 
         self.frame_number = 0
         self.min_frame = 0
@@ -217,6 +528,13 @@ class WellsVideoPlayerGUI(HDF5VideoPlayerGUI):
             lambda: setattr(self, 'target_frames_to_read',
                 self.ui.n_frames_to_read_spinBox.value())
             )
+        self.ui.n_decode_workers_spinBox.setMinimum(0)
+        self.ui.n_decode_workers_spinBox.setMaximum(os.cpu_count() or 1)
+        self.ui.n_decode_workers_spinBox.setValue(self.n_decode_workers)
+        self.ui.n_decode_workers_spinBox.editingFinished.connect(
+            lambda: setattr(self, 'n_decode_workers',
+                self.ui.n_decode_workers_spinBox.value())
+            )
 
         self.ui.wells_comboBox.activated.connect(self.updateImGroup)
         self.ui.wells_comboBox.currentIndexChanged.connect(self.updateImGroup)
@@ -226,6 +544,12 @@ class WellsVideoPlayerGUI(HDF5VideoPlayerGUI):
         self.ui.prev_well_b.clicked.connect(self.prev_well_fun)
 
         self.mainImage._view.wheelEvent = self.do_nothing
+        self.mainImage._view.mousePressEvent = self._on_view_clicked
+        self.ui.plate_overview_checkBox.toggled.connect(
+            self.set_plate_overview)
+        self.ui.montage_comboBox.currentTextChanged.connect(
+            self.set_montage_mode)
+        self.ui.lazy_wells_checkBox.toggled.connect(self.set_lazy_wells)
 
     @property
     def wellsdef_filename(self):
@@ -233,31 +557,8 @@ class WellsVideoPlayerGUI(HDF5VideoPlayerGUI):
 
     @wellsdef_filename.setter
     def wellsdef_filename(self, value: str):
-
-        if ('MaskedVideos' in value) and (not Path(value).exists()):
-            # input was a masked video, but it does not exist.
-            # new value for the wells definition file
-            value = mask2feats(value)
-
-        assert Path(value).exists(), (
-            'either the masked or featuresN video must exist')
-
-        # do I need to find a different file for the video data?
-
-        if 'MaskedVideos' in value:
-            vfile = value
-            try:
-                vid = selectVideoReader(vfile)
-            except OSError as ose:
-                print(repr(ose))
-                print(
-                    'Masked video does not have full_data, trying raw video')
-                vfile = tierpsyfile2raw(value)
-        else:
-            vfile = tierpsyfile2raw(value)
-
-        self._wellsdef_filename = value
-        self.vfilename = vfile
+        self._wellsdef_filename, self.vfilename, self._video_info = (
+            resolve_video_files(value))
 
     @property
     def vfilename(self):
@@ -274,9 +575,31 @@ class WellsVideoPlayerGUI(HDF5VideoPlayerGUI):
     @target_frames_to_read.setter
     def target_frames_to_read(self, value):
         self._target_frames_to_read = value
+        self.prefetcher.clear()
         if len(self.wellsdef_filename) > 0:
             self.updateVideoFile(self.wellsdef_filename)
 
+    @property
+    def n_decode_workers(self):
+        return self._n_decode_workers
+
+    @n_decode_workers.setter
+    def n_decode_workers(self, value):
+        if value == self._n_decode_workers:
+            return
+        old_pool = self._decode_pool
+        # the pool is started here, from the main thread
+        self._decode_pool = make_decode_pool(value) if value > 1 else None
+        self._n_decode_workers = value
+        if self.ui.n_decode_workers_spinBox.value() != value:
+            self.ui.n_decode_workers_spinBox.setValue(value)
+        # loads already running may be using the old pool, let them finish
+        # (queued ones are cancelled, and will use the new pool if needed)
+        self.prefetcher.clear(wait=True)
+        self.target_frames_to_read = self.target_frames_to_read
+        if old_pool is not None:
+            old_pool.shutdown()
+
     # def set_target_frames_to_read(self, value):
     #     """wrapper otherwise the callback does not work"""
     #     self.target_frames_to_read = value
@@ -298,21 +621,41 @@ class WellsVideoPlayerGUI(HDF5VideoPlayerGUI):
 
     def updateVideoFile(self, hdf5_fname):
 
+        # the plate atlas may still be reading the previous video's wells
+        self.stop_plate_atlas_builder()
         # close the if there was another file opened before.
+        # lazy tiles keep the previous video open
+        if isinstance(self.tiles, LazyWellsTiles):
+            self.tiles.release()
+
         if self.fid is not None:
             self.fid.close()
             self.mainImage.cleanCanvas()
             self.fid = None
             self.image_group = None
             self.imgstore_name = ''
-            self.wellsdef_filename = ''
+            self._wellsdef_filename = ''
             self.well_name = ''
             self.well_names = []
             self.tiles = None
             self.ui.wells_comboBox.clear()
             self.wells_df = None
 
-        self.wellsdef_filename = hdf5_fname
+        self.pixmap_cache.clear()
+
+        # use the prefetched data if available, or wait for it to be loaded
+        key = (hdf5_fname, self._target_frames_to_read)
+        if self.is_lazy_wells:
+            loaded = self._load_video(key)
+        else:
+            loaded = self.prefetcher.get(key)
+        self._wellsdef_filename = loaded['wellsdef_filename']
+        self.vfilename = loaded['vfilename']
+        self._video_info = loaded['video_info']
+        self.tiles = loaded['tiles']
+        self.wells_df = loaded['wells_df'].copy()
+        self.well_names = self.wells_df.index.to_list()
+
         self.imgstore_name = Path(hdf5_fname).parent.name
         self.ui.label_vid.setText(self.imgstore_name)
         # self.videos_dir = self.vfilename.rpartition(os.sep)[0] + os.sep
@@ -333,7 +676,12 @@ class WellsVideoPlayerGUI(HDF5VideoPlayerGUI):
         #         " Please select a valid file",
         #         QMessageBox.Ok)
         #     return
-        self.load_data()  # get video data and wells info
+
+        self.montages = {}
+        self.plate_atlas = None
+        self.plate_atlas_positions = None
+        if self.is_plate_overview:
+            self.build_plate_atlas()
 
         self.ui.wells_comboBox.clear()
         for wi, wn in enumerate(self.well_names):
@@ -341,6 +689,166 @@ class WellsVideoPlayerGUI(HDF5VideoPlayerGUI):
         self.updateImGroup(0)
         return
 
+    def build_plate_atlas(self):
+        """
+        Start building the thumbnails of all wells in the background
+        """
+        if self.tiles is None:
+            return
+        builder = PlateAtlasBuilder(
+            (self.vfilename, self._target_frames_to_read),
+            self.tiles,
+            self.wells_df,
+            thumb_size=self.plate_thumb_size,
+            parent=self)
+        builder.atlas_ready.connect(self._on_plate_atlas_ready)
+        # keep a reference while it runs
+        self._plate_atlas_builder = builder
+        builder.start()
+
+    def stop_plate_atlas_builder(self):
+        """
+        Stop building the plate atlas, and wait until the builder is done
+        with the tiles
+        """
+        if self._plate_atlas_builder is not None:
+            self._plate_atlas_builder.requestInterruption()
+            self._plate_atlas_builder.wait()
+            self._plate_atlas_builder = None
+
+    def _on_plate_atlas_ready(self, key, atlas, positions):
+        if key != (self.vfilename, self._target_frames_to_read):
+            # the video changed while building
+            return
+        self.plate_atlas = atlas
+        self.plate_atlas_positions = positions
+        if self.is_plate_overview:
+            self.updateImage()
+            self.mainImage.zoomFitInView()
+
+    def set_plate_overview(self, checked):
+        """
+        Switch between showing one well and all wells at once
+        """
+        self.is_plate_overview = checked
+        if self.ui.plate_overview_checkBox.isChecked() != checked:
+            self.ui.plate_overview_checkBox.setChecked(checked)
+        if checked and self.plate_atlas is None and (
+                self._plate_atlas_builder is None
+                or not self._plate_atlas_builder.isRunning()):
+            self.build_plate_atlas()
+        if self.image_group is not None:
+            self.updateImage()
+            self.mainImage.zoomFitInView()
+
+    def set_montage_mode(self, mode):
+        assert mode in MONTAGE_MODES, f'Unknown montage mode {mode}'
+        self.montage_mode = mode
+        if self.ui.montage_comboBox.currentText() != mode:
+            self.ui.montage_comboBox.setCurrentText(mode)
+        if self.image_group is not None:
+            self.updateImage()
+            self.mainImage.zoomFitInView()
+
+    def set_lazy_wells(self, checked):
+        """
+        Switch between loading the whole video at once, and only reading
+        each well from the video when it is shown
+        """
+        if self.ui.lazy_wells_checkBox.isChecked() != checked:
+            self.ui.lazy_wells_checkBox.setChecked(checked)
+        if self.is_lazy_wells == checked:
+            return
+        self.is_lazy_wells = checked
+        # drop what was prefetched and reload the current video
+        self.target_frames_to_read = self.target_frames_to_read
+
+    def getMontagePixmap(self):
+        """
+        Montage of the current well, from the cache or made now
+        """
+        key = (self.vfilename, self.well_name, self.montage_mode)
+        pyramid = self.pixmap_cache.get(key)
+        if pyramid is None:
+            montage_key = (self.well_name, self.montage_mode)
+            if montage_key not in self.montages:
+                self.montages[montage_key] = make_montage(
+                    self.image_group, self.montage_mode)
+            self.frame_img = self.montages[montage_key]
+            self._normalizeImage()
+            pyramid = tuple(
+                QPixmap.fromImage(self._convert2Qimg(level))
+                for level in build_pyramid(
+                    self.frame_img, n_levels=self.pyramid_levels))
+            self.pixmap_cache.put(key, pyramid)
+        return pyramid
+
+    def updateImage(self):
+        if not self.is_plate_overview or self.plate_atlas is None:
+            self._clear_plate_overlay()
+            if self.montage_mode == 'frames' or self.image_group is None:
+                return super().updateImage()
+            self.mainImage.setPixmap(self.getMontagePixmap())
+            return
+        frame_number = min(self.frame_number, len(self.plate_atlas) - 1)
+        key = (self.vfilename, None, frame_number)
+        pixmap = self.pixmap_cache.get(key)
+        if pixmap is None:
+            pixmap = QPixmap.fromImage(
+                self._convert2Qimg(self.plate_atlas[frame_number]))
+            self.pixmap_cache.put(key, pixmap)
+        self.mainImage.setPixmap(pixmap)
+        self.refresh_plate_overlay()
+
+    def _plate_wells_colours(self):
+        """
+        Colour to outline each well with in the plate overview
+        """
+        return {self.well_name: 'white'}
+
+    def _clear_plate_overlay(self):
+        for item in self._plate_overlay_items:
+            self.mainImage._scene.removeItem(item)
+        self._plate_overlay_items = []
+
+    def refresh_plate_overlay(self):
+        self._clear_plate_overlay()
+        if not self.is_plate_overview or self.plate_atlas is None:
+            return
+        sz = self.plate_thumb_size
+        for well_name, colour in self._plate_wells_colours().items():
+            if well_name not in self.plate_atlas_positions:
+                continue
+            row, col = self.plate_atlas_positions[well_name]
+            item = QGraphicsRectItem(QRectF(col * sz, row * sz, sz, sz))
+            pen = QPen(QColor(colour))
+            pen.setWidth(3)
+            item.setPen(pen)
+            self.mainImage._scene.addItem(item)
+            self._plate_overlay_items.append(item)
+
+    def _on_view_clicked(self, event):
+        if not self.is_plate_overview or self.plate_atlas is None:
+            return QGraphicsView.mousePressEvent(self.mainImage._view, event)
+        pos = self.mainImage._view.mapToScene(event.pos())
+        row = int(pos.y() // self.plate_thumb_size)
+        col = int(pos.x() // self.plate_thumb_size)
+        for well_name, well_pos in self.plate_atlas_positions.items():
+            if (pos.x() >= 0) and (pos.y() >= 0) and well_pos == (row, col):
+                self.on_plate_tile_clicked(well_name, event.modifiers())
+                return
+
+    def on_plate_tile_clicked(self, well_name, modifiers):
+        """
+        Open the clicked well
+        """
+        self.set_plate_overview(False)
+        self.ui.wells_comboBox.setCurrentIndex(
+            self.well_names.index(well_name))
+
+    def _pixmapKey(self, frame_number):
+        return (self.vfilename, self.well_name, frame_number)
+
     def updateImGroup(self, well_index):
         if well_index < 0:
             # this happens when clearing the combobox
@@ -357,6 +865,7 @@ class WellsVideoPlayerGUI(HDF5VideoPlayerGUI):
         self.tot_frames = self.image_group.shape[0]
         self.image_height = self.image_group.shape[1]
         self.image_width = self.image_group.shape[2]
+        self.updateContrast()
 
         self.ui.spinBox_frame.setMaximum(self.tot_frames - 1)
         self.ui.imageSlider.setMaximum(self.tot_frames - 1)
@@ -364,6 +873,9 @@ class WellsVideoPlayerGUI(HDF5VideoPlayerGUI):
         self.frame_number = 0
         self.ui.spinBox_frame.setValue(self.frame_number)
 
+        # wells are small, ready all frames for scrubbing
+        self.warmPixmapCache()
+
         self.updateImage()
         # self.readCurrentFrame()
         # print(self.frame_img.shape)
@@ -384,33 +896,69 @@ class WellsVideoPlayerGUI(HDF5VideoPlayerGUI):
             max(0, self.ui.wells_comboBox.currentIndex() - 1))
         return
 
-    def load_data(self):
-        # read the video data
-        vid = selectVideoReader(self.vfilename)
-        #print(len(vid))
-        print(int(vid.__len__()))
-        n_fulldata_frames = int(vid.__len__())#int(len(vid))
-        #print(len(vid))
-        if self._target_frames_to_read >= n_fulldata_frames:
-            skip = 1
+    def _load_video(self, key):
+        """
+        Find the files and load the tiles of a video.
+        Runs in the prefetcher's worker threads, do not touch the ui here.
+        """
+        hdf5_fname, target_frames_to_read = key
+        wellsdef_filename, vfilename, video_info = resolve_video_files(
+            hdf5_fname)
+        if self.is_lazy_wells and vfilename.endswith('hdf5'):
+            tiles, wells_df = load_lazy_tiles(
+                wellsdef_filename,
+                vfilename,
+                target_frames_to_read,
+                video_info=video_info)
         else:
-            # pure python version of ceil
-            skip = -(-n_fulldata_frames // self._target_frames_to_read)
-        # this is a list of tuples (status, 2D frame)
-        img_stack = [
-            vid.read_frame(ii)
-            for ii in range(0, n_fulldata_frames, skip)]
-        img_stack = [f[None, :, :] for s, f in img_stack if (s == 1)]
-        img_stack = concatenate(img_stack, axis=0)
-        vid.release()
-        # read wells definition
-        fovsplitter = SimpleFOVSplitter(self.wellsdef_filename)
-        # chop up wells images and store
-        self.tiles = fovsplitter.tile_FOV(img_stack)
-        self.wells_df = fovsplitter.wells.copy().set_index('well_name')
+            tiles, wells_df = load_tiles(
+                wellsdef_filename,
+                vfilename,
+                target_frames_to_read,
+                video_info=video_info,
+                n_decode_workers=self.n_decode_workers,
+                decode_max_memory_mb=self.decode_max_memory_mb,
+                decode_pool=self._decode_pool,
+                tiles_cache_max_gb=(
+                    self.tiles_cache_max_gb if self.use_tiles_cache
+                    else None),
+                )
+        return {
+            'wellsdef_filename': wellsdef_filename,
+            'vfilename': vfilename,
+            'video_info': video_info,
+            'tiles': tiles,
+            'wells_df': wells_df,
+            }
+
+    def prefetch_videos(self, hdf5_fnames):
+        """
+        Start loading these videos in the background, in order
+        """
+        if self.is_lazy_wells:
+            # nothing to gain, wells are read when shown
+            return
+        self.prefetcher.prefetch(
+            [(fname, self._target_frames_to_read) for fname in hdf5_fnames])
+
+    def load_data(self):
+        # get video data and wells info
+        loaded = self._load_video(
+            (self.wellsdef_filename, self._target_frames_to_read))
+        self.tiles = loaded['tiles']
+        self.wells_df = loaded['wells_df']
         self.well_names = self.wells_df.index.to_list()
         return
 
+    def closeEvent(self, event):
+        self.prefetcher.shutdown()
+        self.stop_plate_atlas_builder()
+        if isinstance(self.tiles, LazyWellsTiles):
+            self.tiles.release()
+        if self._decode_pool is not None:
+            self._decode_pool.shutdown(wait=False)
+        super().closeEvent(event)
+
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
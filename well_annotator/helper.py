@@ -8,6 +8,9 @@ Created on Tue Jul 14 12:20:26 2020
 
 import datetime
 import re
+import sqlite3
+import threading
+from contextlib import closing
 from pathlib import Path
 
 import cv2
@@ -16,7 +19,15 @@ import numpy as np
 import pandas as pd
 import torch
 
+from well_annotator.SimpleFOVSplitter import stack_wells_tensor
+
+# the hdf5 library is not thread safe: hold this whenever reading or writing
+# hdf5 files from code that can run outside of the main thread
+HDF5_LOCK = threading.RLock()
+
 WELLS_ANNOTATION_EXT = "_wells_annotations.hdf5"
+# database that several annotators can use at the same time
+WELLS_ANNOTATION_SQLITE_EXT = "_wells_annotations.sqlite"
 FILES_DF_COLS = ["file_id", "filename"]
 WELLS_ANNOTATIONS_DF_COLS = [
     "file_id",
@@ -28,6 +39,10 @@ WELLS_ANNOTATIONS_DF_COLS = [
     "well_label",
 ]
 
+# changes to the annotations since /wells_annotations_df was last written,
+# same columns plus a timestamp
+WELLS_ANNOTATIONS_JOURNAL_KEY = "/wells_annotations_journal"
+
 WELL_LABELS = {
     1: "good",
     2: "misaligned",
@@ -52,6 +67,13 @@ BTN_COLOURS = {
     9: "red",
 }
 
+# size of the square cropped from the centre of each well before
+# resizing it for the CNN
+CNN_CROP_SIZE = 640
+
+# number of images given to the CNN at once, when classifying many wells
+CNN_BATCH_IMAGES = 512
+
 BUTTON_STYLESHEET_STR = (
     "QPushButton:checked "
     + "{border: 2px solid; border-radius: 6px; background-color: %s }"
@@ -72,6 +94,16 @@ def check_good_input(input_path: Path):
         assert _is_child_of_tierpsy_out_dir(
             input_path
         ), "input_path should contain MaskedVideos or Results"
+    elif input_path.name.endswith(WELLS_ANNOTATION_SQLITE_EXT):
+        with closing(sqlite3.connect(f"file:{input_path}?mode=ro", uri=True)) as con:
+            tables = [
+                row[0]
+                for row in con.execute(
+                    "SELECT name FROM sqlite_master WHERE type='table'"
+                )
+            ]
+        for table in ["filenames", "wells", "labels"]:
+            assert table in tables, f"Input database missing table {table}"
     else:
         assert input_path.name.endswith("hdf5"), "Please enter an hdf5 file."
         with pd.HDFStore(input_path, "r") as fid:
@@ -87,6 +119,8 @@ def find_wellsanns_file_in_dir(working_dir: Path):
     """
     Scan the folder working_dir looking for a wells annotation file with
     existing progress. Return the path to the file if found, None if not.
+    A _wells_annotations.sqlite database takes precedence over hdf5 files,
+    as it would have been created from one of them.
 
     Parameters
     ----------
@@ -106,7 +140,9 @@ def find_wellsanns_file_in_dir(working_dir: Path):
     """
 
     # look for the annotation file
-    annotation_files = list(working_dir.rglob("*" + WELLS_ANNOTATION_EXT))
+    annotation_files = list(working_dir.rglob("*" + WELLS_ANNOTATION_SQLITE_EXT))
+    if len(annotation_files) == 0:
+        annotation_files = list(working_dir.rglob("*" + WELLS_ANNOTATION_EXT))
     # handle output
     if len(annotation_files) == 0:
         annotation_file = None
@@ -396,37 +432,56 @@ def preprocess_images_for_CNN(images, device=None):
     Parameters
     ----------
     images : numpy array
-        n_frames x height x width, uint8
+        n_frames x height x width, uint8, the frames of one well
+        or n_wells x n_frames x CNN_CROP_SIZE x CNN_CROP_SIZE
+        (see tile_FOV_tensor and stack_wells_tensor), resized in one batch
 
     Returns
     -------
     torch tensor
         n_frames x 1 x 160 x 160, float
+        or n_wells x n_frames x 1 x 160 x 160
     """
 
     if device is None:
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-    crop_sz = 640  # crop size before resizing
+    crop_sz = CNN_CROP_SIZE  # crop size before resizing
     img_sz = 160  # size of the image after resizing, dictated by the CNN
     ds_mean = 93.37299001461375 / 255
     ds_std = 54.632948105068145 / 255
-
-    # crop
-    n_imgs, height, width = images.shape
-    top_pad = (height - crop_sz) // 2
-    left_pad = (width - crop_sz) // 2
-    images_out = images[:, top_pad : top_pad + crop_sz, left_pad : left_pad + crop_sz]
+    # cv2 cannot resize images with more than 512 channels
+    max_channels = 512
+
+    # crop the centre of a single well, wells from a tensor already are
+    is_one_well = images.ndim == 3
+    if is_one_well:
+        images = stack_wells_tensor([images], crop_sz)
+    assert images.shape[-2:] == (crop_sz, crop_sz), (
+        f"wells must be tiled to {crop_sz} x {crop_sz} pixels")
+    images_out = np.ascontiguousarray(images)
+    n_wells, n_frames = images_out.shape[:2]
+    images_out = images_out.reshape(-1, crop_sz, crop_sz)
     # resize, using transpose so n_images uses the colour channel for cv2
     # since cv2 knows how to resize an image with a colour channel
-    images_out = images_out.transpose((1, 2, 0))
-    images_out = cv2.resize(images_out, (img_sz, img_sz), interpolation=cv2.INTER_AREA)
-    # transpose for pytorch i.e. n_images, n_colours, img_sz, img_sz
-    images_out = images_out.transpose((2, 0, 1))[:, None, :, :]
+    resized = np.empty((images_out.shape[0], img_sz, img_sz), dtype=images_out.dtype)
+    for first in range(0, images_out.shape[0], max_channels):
+        chunk = np.ascontiguousarray(
+            images_out[first : first + max_channels].transpose((1, 2, 0))
+        )
+        chunk = cv2.resize(chunk, (img_sz, img_sz), interpolation=cv2.INTER_AREA)
+        # one channel images come back 2D
+        chunk = chunk.reshape(img_sz, img_sz, -1).transpose((2, 0, 1))
+        resized[first : first + max_channels] = chunk
+    # pytorch wants n_images, n_colours, img_sz, img_sz
+    images_out = resized[:, None, :, :]
     # cast and normalize
     images_out = torch.from_numpy(images_out).float().div(255)
     images_out = (images_out - ds_mean) / ds_std
 
+    if not is_one_well:
+        images_out = images_out.reshape(n_wells, n_frames, *images_out.shape[1:])
+
     return images_out.to(device)
 
 
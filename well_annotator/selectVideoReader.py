@@ -2,16 +2,44 @@
 # from tierpsy.helper.misc import IMG_EXT
 
 # from well_annotator.Readers.ReadVideoFFMPEG import ReadVideoFFMPEG
-from well_annotator.Readers.readVideoHDF5 import readFullDataFromVideoHDF5
+from well_annotator.Readers.readVideoHDF5 import (
+    readFullDataFromVideoHDF5, probe_videoHDF5)
 # from well_annotator.Readers.readDatFiles import readDatFiles
 # from well_annotator.Readers.readImages import readImages
 # from well_annotator.Readers.readVideoCapture import readVideoCapture
-from well_annotator.Readers.readLoopBio import readLoopBio
+from well_annotator.Readers.readLoopBio import readLoopBio, probe_loopbio
 
 import os
 
 
-def selectVideoReader(video_file):
+def probe_video(video_file):
+    """
+    Return a VideoInfo (first frame, number of frames, shape, dtype)
+    read from the video's metadata only, without decoding any frame.
+    Raises OSError if the video cannot be read, like selectVideoReader.
+    Can be passed to selectVideoReader to skip probing again.
+    """
+    if video_file.endswith('hdf5'):
+        video_info = probe_videoHDF5(video_file)
+    elif video_file.endswith('.yaml'):
+        video_info = probe_loopbio(video_file)
+    else:
+        raise Exception('Only HDF5 and loopbio videos are supported so far')
+
+    if video_info.width == 0 or video_info.height == 0:
+        raise RuntimeError
+
+    return video_info
+
+
+def selectVideoReader(
+        video_file, n_workers=0, max_memory_mb=1024, video_info=None,
+        decode_pool=None):
+    """
+    n_workers, max_memory_mb and decode_pool only affect loopbio videos,
+    see readLoopBio.
+    video_info (from probe_video) saves the readers from probing the video
+    """
     # open video to read
     isHDF5video = video_file.endswith('hdf5')
     # isMJPGvideo = video_file.endswith('.mjpg')
@@ -23,10 +51,15 @@ def selectVideoReader(video_file):
     if isHDF5video:
         # use tables to read hdf5 with lz4 compression generated by the Gecko
         # plugin
-        vid = readFullDataFromVideoHDF5(video_file)
+        vid = readFullDataFromVideoHDF5(video_file, video_info=video_info)
     elif isLoopBio:
         # use opencv VideoCapture
-        vid = readLoopBio(video_file)
+        vid = readLoopBio(
+            video_file,
+            n_workers=n_workers,
+            max_memory_mb=max_memory_mb,
+            video_info=video_info,
+            decode_pool=decode_pool)
     else:
         raise Exception('Only HDF5 and loopbio videos are supported so far')
     # elif isMJPGvideo: